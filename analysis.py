@@ -0,0 +1,198 @@
+from typing import List, Optional
+import argparse
+import io
+import random
+import sys
+
+import discord
+from discord.ext.commands.context import Context
+
+try:
+    import numpy as np
+except ImportError: # optional, only needed for the analysis
+    np = None
+
+from cmds import command, ArgParser, _randomizer_args, _randomizer_problems, _cached_pools, _selected_boxes
+from executor import run_cpu
+from loader import market_index, nemesis_index, mage_index
+
+# Monte Carlo analysis of what the randomizer produces. Instead of running
+# random_cmd over and over, the candidates are turned into arrays and every
+# trial is drawn at once (in chunks, to keep memory in check).
+# Run offline with `python analysis.py [--trials N] [random arguments]`,
+# or as the owner with `!analyze [--trials N] [random arguments]`.
+
+_analysis_args = ArgParser(prog="analyze", add_help=False)
+_analysis_args.add_argument("--trials", "-t", type=int, default=1000000)
+
+# how many random keys to hold in memory at once
+_chunk_size = 4000000
+
+def _label(value: dict) -> str:
+    return f"{value['name']} ({value['box']})"
+
+class _Catalog:
+    """Every card, mage and nemesis the randomizer could ever pick, as arrays."""
+
+    def __init__(self):
+        self.boxes = sorted(set(market_index) | set(nemesis_index) | set(mage_index))
+        box_ids = {box: i for i, box in enumerate(self.boxes)}
+
+        self.cards = [card for costs in market_index.values() for cards in costs.values() for values in cards.values() for card in values]
+        self.card_cost = np.array([x["cost"] for x in self.cards], dtype=np.int64)
+        self.card_type = np.array([x["type"] for x in self.cards])
+        self.card_box = np.array([box_ids[x["box"]] for x in self.cards], dtype=np.int64)
+
+        self.nemeses = [mat for difficulties in nemesis_index.values() for values in difficulties.values() for mat in values]
+        self.nemesis_difficulty = np.array([x["difficulty"] for x in self.nemeses], dtype=np.int64)
+        self.nemesis_box = np.array([box_ids[x["box"]] for x in self.nemeses], dtype=np.int64)
+
+        self.mages = [mat for ratings in mage_index.values() for values in ratings.values() for mat in values]
+        self.mage_rating = np.array([x["rating"] for x in self.mages], dtype=np.int64)
+        self.mage_box = np.array([box_ids[x["box"]] for x in self.mages], dtype=np.int64)
+
+        self._box_ids = box_ids
+
+    def box_mask(self, boxes: List[str], array):
+        return np.isin(array, [self._box_ids[x] for x in boxes if x in self._box_ids])
+
+def _sample(rng, trials: int, size: int, k: int, exclude=None):
+    """Draw k distinct indices out of range(size) for each trial; returns a (trials, k) array."""
+    if not k:
+        return np.empty((trials, 0), dtype=np.int64)
+    keys = rng.random((trials, size))
+    if exclude is not None: # never pick these (one per trial)
+        keys[np.arange(trials), exclude] = 2.0
+    return np.argpartition(keys, k - 1, axis=1)[:, :k]
+
+def run_analysis(namespace: argparse.Namespace, boxes: List[str], trials: int, seed: int) -> str:
+    catalog = _Catalog()
+    rng = np.random.default_rng(seed)
+
+    nemesis_mask = catalog.box_mask(boxes, catalog.nemesis_box)
+    nemesis_mask &= (catalog.nemesis_difficulty >= namespace.lowest_difficulty) & (catalog.nemesis_difficulty <= namespace.highest_difficulty)
+    mage_mask = catalog.box_mask(boxes, catalog.mage_box)
+    mage_mask &= (catalog.mage_rating >= namespace.minimum_rating) & (catalog.mage_rating <= namespace.maximum_rating)
+    card_mask = catalog.box_mask(boxes, catalog.card_box)
+
+    nemeses = np.flatnonzero(nemesis_mask)
+    mages = np.flatnonzero(mage_mask)
+    market = {ctype: np.flatnonzero(card_mask & (catalog.card_type == ctype)) for ctype in ("G", "R", "S")}
+    # positions of the cheap gems within the gem candidates
+    cheap = np.flatnonzero(catalog.card_cost[market["G"]] <= 3)
+
+    needed = {"G": namespace.gem_count, "R": namespace.relic_count, "S": namespace.spell_count}
+    forced = bool(namespace.force_cheap_gem and namespace.gem_count)
+
+    nemesis_counts = np.zeros(len(catalog.nemeses), dtype=np.int64)
+    mage_counts = np.zeros(len(catalog.mages), dtype=np.int64)
+    card_counts = np.zeros(len(catalog.cards), dtype=np.int64)
+    totals = np.zeros(trials, dtype=np.int64)
+
+    widest = max(len(mages), *(len(x) for x in market.values()), 1)
+    chunk = max(1, _chunk_size // widest)
+    for start in range(0, trials, chunk):
+        n = min(chunk, trials - start)
+        nemesis_counts += np.bincount(nemeses[rng.integers(len(nemeses), size=n)], minlength=len(catalog.nemeses))
+        mage_counts += np.bincount(mages[_sample(rng, n, len(mages), namespace.player_count)].ravel(), minlength=len(catalog.mages))
+
+        picked = []
+        for ctype, pool in market.items():
+            k = needed[ctype]
+            if ctype == "G" and forced:
+                first = cheap[rng.integers(len(cheap), size=n)]
+                rest = _sample(rng, n, len(pool), k - 1, exclude=first)
+                picked.append(pool[np.concatenate([first[:, None], rest], axis=1)])
+            else:
+                picked.append(pool[_sample(rng, n, len(pool), k)])
+        picked = np.concatenate(picked, axis=1)
+        card_counts += np.bincount(picked.ravel(), minlength=len(catalog.cards))
+        totals[start:start+n] = catalog.card_cost[picked].sum(axis=1)
+
+    result = [f"Monte Carlo analysis of {trials} setups (seed {seed})", f"Settings: {namespace}", ""]
+
+    def frequencies(title: str, items: list, counts, candidates, per_trial: int, universe=None):
+        if not per_trial: # none of these are drawn at all
+            return
+        expected = per_trial / len(candidates) if len(candidates) else 0
+        result.append(f"{title} ({len(candidates)} candidates, {expected:.4%} expected each):")
+        rates = counts[candidates] / trials
+        for i in candidates[np.argsort(-rates, kind="stable")]:
+            rate = counts[i] / trials
+            result.append(f"  {rate:9.4%}  x{rate / expected if expected else 0:5.3f}  {_label(items[i])}")
+        never = [_label(items[i]) for i in candidates if not counts[i]]
+        if never:
+            result.append(f"  Never picked: {', '.join(never)}")
+        if universe is None:
+            universe = np.arange(len(items))
+        excluded = np.setdiff1d(universe, candidates)
+        if len(excluded):
+            result.append(f"  Cannot be picked with these settings: {len(excluded)}")
+        result.append("")
+
+    frequencies("Nemeses", catalog.nemeses, nemesis_counts, nemeses, 1)
+    frequencies("Mages", catalog.mages, mage_counts, mages, namespace.player_count)
+    for name, ctype in (("Gems", "G"), ("Relics", "R"), ("Spells", "S")):
+        frequencies(name, catalog.cards, card_counts, market[ctype], needed[ctype], np.flatnonzero(catalog.card_type == ctype))
+
+    for name, ctype in (("gems", "G"), ("relics", "R"), ("spells", "S")):
+        pool = market[ctype]
+        weights = np.bincount(catalog.card_cost[pool], weights=card_counts[pool])
+        total = weights.sum()
+        if total:
+            result.append(f"Cost distribution of market {name}: " +
+                          ", ".join(f"{cost}: {w / total:.2%}" for cost, w in enumerate(weights) if w))
+
+    p5, p50, p95 = np.percentile(totals, [5, 50, 95])
+    result.append(f"Total market cost per setup: mean {totals.mean():.2f}, min {totals.min()}, " +
+                  f"5% {p5:g}, median {p50:g}, 95% {p95:g}, max {totals.max()}")
+
+    return "\n".join(result)
+
+def _prepare(args, ctx: Optional[Context] = None):
+    """Parse the arguments and check that the settings can produce a setup at all."""
+    own, rest = _analysis_args.parse_known_args(args)
+    if own.trials < 1:
+        raise RuntimeError("--trials must be at least 1")
+    namespace = _randomizer_args.parse_args(rest)
+    if namespace.expedition:
+        raise RuntimeError("Expeditions are not supported by the analysis")
+    boxes, error = _selected_boxes(ctx, namespace.boxes)
+    if boxes is None:
+        raise RuntimeError(error)
+    problems = _randomizer_problems(namespace, _cached_pools(namespace, boxes)[1])
+    if problems:
+        raise RuntimeError("Impossible settings:\n" + "\n".join(problems))
+    seed = namespace.seed
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    return namespace, boxes, own.trials, seed
+
+@command()
+async def analyze(ctx: Context, *args):
+    if not await ctx.bot.is_owner(ctx.author):
+        return
+    if np is None:
+        await ctx.send("NumPy is not installed, cannot run the analysis.")
+        return
+    try:
+        namespace, boxes, trials, seed = _prepare(args, ctx)
+    except (argparse.ArgumentError, RuntimeError) as e:
+        await ctx.send(str(e))
+        return
+
+    await ctx.send(f"Running {trials} trials, this may take a moment.")
+    # in the render pool, so that a reload waits for it
+    report = await run_cpu(run_analysis, namespace, boxes, trials, seed)
+    await ctx.send(file=discord.File(io.BytesIO(report.encode("utf-8")), filename="random_analysis.txt"))
+
+if __name__ == "__main__":
+    from loader import load
+    if np is None:
+        sys.exit("NumPy is required for the analysis")
+    load()
+    try:
+        namespace, boxes, trials, seed = _prepare(sys.argv[1:])
+    except (argparse.ArgumentError, RuntimeError) as e:
+        sys.exit(str(e))
+    print(run_analysis(namespace, boxes, trials, seed))
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+import asyncio
+import io
+import os
+import time
+
+import discord
+
+from loader import log
+from optimise_assets import load_manifest, variants_dir
+
+import config
+
+# Delivery of the art in assets/. The files are read in the default executor
+# and kept in a bounded in-memory cache. Once an asset has been uploaded, the
+# URL of the resulting attachment is remembered and later lookups send an
+# embed pointing to it instead of uploading the file again.
+# Discord signs attachment URLs with an expiry time (the "ex" parameter, in
+# hex), so a URL is only reused until shortly before it expires.
+# If optimise_assets.py was run, the optimised variant of an asset is sent
+# instead, as long as the source did not change since.
+
+_max_bytes = getattr(config, "asset_cache_size", 32 * 1024 * 1024)
+# how long before expiry a URL stops being reused, in seconds
+_url_margin = 3600
+
+_data = OrderedDict() # type: OrderedDict[str, Tuple[bytes, str]]
+_size = 0
+_urls = {} # type: Dict[str, Tuple[str, Optional[float]]]
+_manifest = None # type: Optional[Dict[str, dict]]
+
+stats = {"uploads": 0, "links": 0, "reads": 0, "hits": 0}
+
+def clear() -> None:
+    global _size, _manifest
+    _data.clear()
+    _urls.clear()
+    _size = 0
+    _manifest = None
+
+def _read(filename: str) -> Tuple[bytes, str]:
+    """Read an asset, or its optimised variant; returns the data and the name to upload it as."""
+    global _manifest
+    if _manifest is None:
+        _manifest = load_manifest()
+    path = os.path.join("assets", filename)
+    entry = _manifest.get(filename)
+    if entry and entry["variant"]:
+        stat = os.stat(path)
+        variant = os.path.join(variants_dir, entry["variant"])
+        # the variants directory may have been cleaned out since
+        if (stat.st_mtime_ns, stat.st_size) == (entry["mtime"], entry["size"]) and os.path.isfile(variant):
+            path = variant
+            filename = os.path.splitext(filename)[0] + os.path.splitext(entry["variant"])[1]
+    with open(path, mode="rb") as f:
+        return f.read(), filename
+
+def _expiry(url: str) -> Optional[float]:
+    ex = parse_qs(urlsplit(url).query).get("ex")
+    if not ex:
+        return None
+    try:
+        return int(ex[0], 16)
+    except ValueError:
+        return None
+
+async def read_asset(filename: str) -> Tuple[bytes, str]:
+    global _size
+    if filename in _data:
+        _data.move_to_end(filename)
+        stats["hits"] += 1
+        return _data[filename]
+
+    value = await asyncio.get_running_loop().run_in_executor(None, _read, filename)
+    stats["reads"] += 1
+    if len(value[0]) <= _max_bytes:
+        _data[filename] = value
+        _size += len(value[0])
+        while _size > _max_bytes:
+            _size -= len(_data.popitem(last=False)[1][0])
+    return value
+
+async def send_asset(ctx, filename: str) -> None:
+    """Send an asset to ctx, which only needs an async send() returning the message."""
+    if filename in _urls:
+        url, expiry = _urls[filename]
+        if expiry is None or expiry - _url_margin > time.time():
+            stats["links"] += 1
+            await ctx.send(embed=discord.Embed().set_image(url=url))
+            return
+        del _urls[filename]
+
+    data, name = await read_asset(filename)
+    message = await ctx.send(file=discord.File(io.BytesIO(data), filename=name))
+    stats["uploads"] += 1
+    attachments = getattr(message, "attachments", None)
+    if attachments:
+        _urls[filename] = (attachments[0].url, _expiry(attachments[0].url))
+    else:
+        log(f"No attachment came back for {filename}", level="local")
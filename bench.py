@@ -0,0 +1,287 @@
+from contextlib import redirect_stdout
+from typing import Callable, Dict, List, Optional
+import argparse
+import asyncio
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import main # loads the content and registers every command
+from cmds import complete_match, content_dicts, get_card, parse_query, random_cmd, _search
+from harness import FakeBot, FakeChannel, FakeContext, FakeGuild, FakeUser
+from loader import log
+import loader
+import synthetic
+
+# Times the load, the lookups, !search, !random and every renderer, on the
+# real content and on bigger copies of it: a dataset scaled N times has the
+# content N times over (the copies with their own boxes, prefixes and names,
+# references between them kept intact) and N guilds with their own overlays.
+# With --synthetic, made-up content of that many times the boxes is used
+# instead, from synthetic.py. The results are written as JSON, and can be
+# compared with an earlier run.
+# Run with `python bench.py [--scales 1,10,100,1000] [--synthetic] [--output FILE] [--compare FILE]`.
+
+_output_file = "bench_results.json"
+# files copied as they are into a scaled dataset
+_static_files = ("card_types.csv", "mage_ability_types.csv", "waves.csv")
+# cards each guild overlay adds, and how many of them reuse a name from the content
+_guild_cards = 20
+_guild_collisions = 0.5
+_first_guild = 100000000000000000
+
+def _read(path: str) -> List[List[str]]:
+    with open(path, "rt", encoding="utf-8-sig", newline="") as f:
+        return list(csv.reader(f, dialect="excel"))
+
+def _write(path: str, rows: List[List[str]]) -> None:
+    with open(path, "wt", encoding="utf-8", newline="") as f:
+        csv.writer(f, dialect="excel").writerows(rows)
+
+def _letters(k: int, width: int) -> str:
+    value = ""
+    for i in range(width):
+        k, r = divmod(k, 26)
+        value = chr(ord("A") + r) + value
+    return value
+
+def _link(name: str, dest: str) -> None:
+    try:
+        os.symlink(os.path.abspath(name), os.path.join(dest, name), target_is_directory=True)
+    except OSError: # no symlinks on this system
+        shutil.copytree(name, os.path.join(dest, name))
+
+def scale_dataset(dest: str, factor: int, guilds: int) -> None:
+    """Write the content factor times over into dest, with that many guild overlays."""
+    width = max(1, len(_letters(factor - 1, 8).lstrip("A")))
+    for name in _static_files:
+        shutil.copy(name, dest)
+    for name in ("assets", "unique"):
+        _link(name, dest)
+
+    tables = {name: _read(name) for name in ("boxes.csv", "player_cards.csv", "nemesis_cards.csv", "player_mats.csv",
+                                              "nemesis_mats.csv", "breaches.csv", "treasures.csv")}
+    out = {name: [] for name in tables}
+    for k in range(factor):
+        tag = "Q" + _letters(k, width)
+        rows = lambda name: (x for x in tables[name] if any(x) and not x[0].startswith("#")) if k else tables[name]
+        rename = (lambda x: f"{tag.title()} {x}" if x else x) if k else (lambda x: x)
+        prefixes = {x[0] for x in tables["boxes.csv"] if any(x) and not x[0].startswith("#")}
+
+        def ids(value: str) -> str:
+            if not k:
+                return value
+            values = []
+            for x in value.split(","):
+                if x.count("-") == 2 and x.split("-")[0] in prefixes: # from another wave
+                    x = x.split("-")[0] + tag + x[x.index("-"):]
+                values.append(x)
+            return ",".join(values)
+
+        for x in rows("boxes.csv"):
+            out["boxes.csv"].append([x[0] + tag if k else x[0], rename(x[1]), x[2]])
+        for x in rows("player_cards.csv"):
+            out["player_cards.csv"].append([rename(x[0])] + x[1:8] + [rename(x[8])] + x[9:])
+        for x in rows("nemesis_cards.csv"):
+            out["nemesis_cards.csv"].append([rename(x[0])] + x[1:12] + [rename(x[12])] + x[13:])
+        for x in rows("player_mats.csv"):
+            out["player_mats.csv"].append([rename(x[0])] + x[1:10] + [ids(x[10]), ids(x[11])] + [rename(y) for y in x[12:16]] + [x[16], rename(x[17])])
+        for x in rows("nemesis_mats.csv"):
+            out["nemesis_mats.csv"].append([rename(x[0])] + x[1:14] + [rename(x[14]), ids(x[15])])
+        for x in rows("breaches.csv"):
+            out["breaches.csv"].append([rename(x[0])] + x[1:7] + [rename(x[7])])
+        for x in rows("treasures.csv"):
+            out["treasures.csv"].append([rename(x[0])] + x[1:5] + [rename(x[5])] + x[6:])
+    for name, rows in out.items():
+        _write(os.path.join(dest, name), rows)
+
+    # every guild has a box of its own, with player and nemesis cards
+    # some of which have the same name as a card everyone has
+    player = [x for x in out["player_cards.csv"] if x and x[0] and not x[0].startswith("#") and not x[7]]
+    nemesis = [x for x in out["nemesis_cards.csv"] if x and x[0] and not x[0].startswith("#")]
+    for i in range(guilds):
+        rng = random.Random(i)
+        folder = os.path.join(dest, "guilds", str(_first_guild + i))
+        os.makedirs(folder)
+        box = f"Guild {i} Promos"
+        prefix = "GLD" + _letters(i, 4)
+        _write(os.path.join(folder, "boxes.csv"), [[prefix, box, "1"]])
+        for name, pool, columns in (("player_cards.csv", player, (8, 9, 10, 11)), ("nemesis_cards.csv", nemesis, (12, 13, 14, 15))):
+            rows = []
+            for num, row in enumerate(rng.sample(pool, min(_guild_cards, len(pool))), 1):
+                row = list(row)
+                if rng.random() >= _guild_collisions:
+                    row[0] = f"{row[0]} {prefix.title()}"
+                b, d, start, end = columns
+                row[b], row[d], row[start], row[end] = box, "", str(num), "0" if name == "player_cards.csv" else ""
+                rows.append(row)
+            _write(os.path.join(folder, name), rows)
+
+def _measure(func: Callable, *args, budget: float = 1.0, runs: int = 50, items: int = 1) -> dict:
+    """Call func(*args) until budget seconds or runs calls are spent, at least once.
+
+    When func handles several items per call, the times are per item.
+    """
+    times = []
+    spent = 0.0
+    while not times or (spent < budget and len(times) < runs):
+        start = time.perf_counter()
+        func(*args)
+        spent += time.perf_counter() - start
+        times.append((time.perf_counter() - start) / max(items, 1))
+    return {"runs": len(times), "items": items, "min_ms": min(times) * 1000, "median_ms": statistics.median(times) * 1000,
+            "mean_ms": statistics.mean(times) * 1000, "max_ms": max(times) * 1000}
+
+def _samples(keys, count: int) -> List[str]:
+    keys = sorted(keys)
+    return random.Random(0).sample(keys, min(count, len(keys)))
+
+def _sizes() -> Dict[str, int]:
+    values = {name: sum(len(x) for x in getattr(loader, name).values()) for name in (
+        "player_cards", "nemesis_cards", "player_mats", "nemesis_mats", "breach_values", "treasure_values", "mechanics")}
+    values["boxes"] = len(loader.waves)
+    values["guilds"] = len([x for x in os.listdir("guilds") if x.isdigit()])
+    return values
+
+def run_benchmarks(budget: float, samples: int) -> Dict[str, dict]:
+    """Time everything on the content in the current directory."""
+    results = {}
+    with open(os.devnull, "wt") as devnull, redirect_stdout(devnull):
+        results["load"] = _measure(loader.load, budget=budget, runs=5)
+    guilds = sorted(int(x) for x in os.listdir("guilds") if x.isdigit())
+    overlay = FakeGuild(guilds[len(guilds) // 2]) if guilds else None
+
+    names = set()
+    for func, mapping in content_dicts:
+        names.update(mapping)
+    queries = _samples(names, samples)
+    queries += [x[:4] for x in queries[::4]] # partial names, some of them ambiguous
+    possible = set()
+    for func, mapping in content_dicts:
+        for key, val in mapping.items():
+            if any(item.get("guild", 0) == 0 for item in val):
+                possible.add(key)
+
+    def lookups(guild):
+        for x in queries:
+            get_card(guild, x)
+    results["get_card"] = _measure(lookups, None, budget=budget, items=len(queries))
+    if overlay is not None:
+        results["get_card (guild overlay)"] = _measure(lookups, overlay, budget=budget, items=len(queries))
+    results["complete_match"] = _measure(lambda: [complete_match(parse_query(x)[0], possible) for x in queries],
+                                         budget=budget, items=len(queries))
+    for x in ("gain", "immediately", "zzzz"):
+        results[f"search {x}"] = _measure(_search, None, x, budget=budget)
+    if overlay is not None:
+        results["search gain (guild overlay)"] = _measure(_search, overlay.id, "gain", budget=budget)
+
+    loop = asyncio.new_event_loop()
+    ctx = FakeContext(FakeBot(False), overlay, FakeChannel(0), FakeUser(0))
+    for args in (("-b", "all", "--seed", "1"), ("-b", "all", "-p", "4", "-n", "10", "--seed", "1"), ("-b", "all", "--expedition", "--seed", "1")):
+        results[f"random {' '.join(args)}"] = _measure(lambda: loop.run_until_complete(random_cmd(ctx, *args)), budget=budget)
+    loop.close()
+
+    for func, mapping in content_dicts:
+        keys = []
+        errors = []
+        for x in _samples(mapping, samples): # what the bot can't render either is left out and reported
+            try:
+                func(0, x)
+            except Exception as e:
+                errors.append(f"{x}: {e!r}")
+            else:
+                keys.append(x)
+        results[f"render {func.__name__}"] = _measure(lambda: [func(0, x) for x in keys], budget=budget, items=len(keys))
+        results[f"render {func.__name__}"]["errors"] = errors
+    return results
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(scales: List[int], budget: float, samples: int, seed: Optional[int] = None) -> dict:
+    """Run on the real content scaled, or on synthetic content when a seed is given."""
+    report = {"time": time.time(), "commit": _commit(), "python": platform.python_version(),
+              "platform": platform.platform(), "budget": budget, "samples": samples, "seed": seed, "datasets": {}}
+    boxes = len([x for x in _read("boxes.csv") if any(x) and not x[0].startswith("#")])
+    root = os.getcwd()
+    for factor in scales:
+        with tempfile.TemporaryDirectory(prefix="lexive-bench-") as dest:
+            if seed is not None:
+                log(f"Writing synthetic content of {boxes * factor} boxes", level="local")
+                with open(os.devnull, "wt") as devnull, redirect_stdout(devnull):
+                    synthetic.generate(dest, seed, boxes * factor, factor)
+                path = dest
+            elif factor == 1:
+                path = root
+            else:
+                log(f"Writing the content scaled {factor} times", level="local")
+                scale_dataset(dest, factor, factor)
+                path = dest
+            os.chdir(path)
+            try:
+                log(f"Running the benchmarks at {factor}x", level="local")
+                results = run_benchmarks(budget, samples)
+                report["datasets"][f"{factor}x"] = {"sizes": _sizes(), "results": results}
+            finally:
+                os.chdir(root)
+    with open(os.devnull, "wt") as devnull, redirect_stdout(devnull):
+        loader.load() # back to the real content
+    return report
+
+def format_report(report: dict, previous: Optional[dict] = None) -> str:
+    values = [f"Commit {report['commit']}, Python {report['python']}" +
+              (f", synthetic content from seed {report['seed']}" if report.get("seed") is not None else "")]
+    for dataset, data in report["datasets"].items():
+        sizes = data["sizes"]
+        values.append(f"\n{dataset}: {sizes['player_cards']} player cards, {sizes['nemesis_cards']} nemesis cards, " +
+                      f"{sizes['boxes']} boxes, {sizes['guilds']} guilds")
+        old = previous["datasets"].get(dataset, {}).get("results", {}) if previous else {}
+        for name, result in data["results"].items():
+            line = f"  {name:<45} {result['median_ms']:>10.3f}ms median, {result['min_ms']:>10.3f}ms min ({result['runs']} runs"
+            line += f", each of {result['items']} items)" if result.get("items", 1) > 1 else ")"
+            if name in old and old[name]["median_ms"]:
+                line += f", {result['median_ms'] / old[name]['median_ms']:.2f}x previous"
+            values.append(line)
+            errors = result.get("errors", ())
+            values.extend(f"    could not render {x}" for x in errors[:5])
+            if len(errors) > 5:
+                values.append(f"    and {len(errors) - 5} more")
+    return "\n".join(values)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the content handling of the bot")
+    parser.add_argument("--scales", default="1,10,100,1000", help="Comma-separated sizes of the content to run on, as multiples of the real one")
+    parser.add_argument("--budget", type=float, default=1.0, help="Seconds to spend on each benchmark, at most (each runs once at least)")
+    parser.add_argument("--samples", type=int, default=20, help="How many names to look up and render")
+    parser.add_argument("--output", "-o", default=_output_file, help="Where to write the results")
+    parser.add_argument("--compare", help="Results of an earlier run to compare with")
+    parser.add_argument("--synthetic", action="store_true", help="Run on synthetic content instead of copies of the real one")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic content")
+    args = parser.parse_args()
+
+    try:
+        scales = [int(x) for x in args.scales.split(",")]
+    except ValueError:
+        parser.error("--scales takes numbers separated by commas")
+    if any(x < 1 for x in scales):
+        parser.error("scales have to be at least 1")
+    previous = None
+    if args.compare:
+        with open(args.compare, "rt") as f:
+            previous = json.load(f)
+
+    report = run(scales, args.budget, args.samples, args.seed if args.synthetic else None)
+    with open(args.output, "wt") as f:
+        json.dump(report, f, indent=1)
+    log(format_report(report, previous), level="local")
+    log(f"\nResults written to {args.output}", level="local")
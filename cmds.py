@@ -1,8 +1,12 @@
 import argparse
+import bisect
+import hashlib
 import random
-import os
+import math
+import time
+import io
 
-from typing import List, Tuple, Optional, Iterable
+from typing import Dict, List, Tuple, Optional, Iterable
 
 import discord
 from discord.ext.commands.context import Context
@@ -17,12 +21,34 @@ from loader import (
     nemesis_mats,
     waves,
     treasure_values,
-    cards_num,
     ctypes,
     assets,
+    market_index,
+    nemesis_index,
+    mage_index,
+    basic_index,
+    expedition_index,
+    randomizer_cache,
+    nemesis_users,
+    starter_users,
+    mage_breaches,
+    box_pages,
+    split_card_id,
+    find_card_ids,
 )
-
-_owner_cmds = ("eval", "reload")
+from user_boxes import get_boxes, set_boxes
+from asset_cache import send_asset
+from executor import run_cpu
+import asset_cache
+import executor
+import outbound
+import singleflight
+from singleflight import coalesce
+
+_owner_cmds = ("eval", "reload", "analyze", "stats", "memstats", "synccommands")
+# the original commands, routed by any part of their name as complete_match always did
+_base_cmds = ("random", "info", "card", "box", "search", "unique", "reload", "issues", "github",
+              "eval", "faq", "wiki", "commands", "outcasts", "whoami")
 
 import config
 
@@ -38,8 +64,8 @@ def command(name=None):
         return func
     return wrapper
 
-def get_card(guild, name: str) -> Tuple[Optional[List[str]], Optional[List[str]]]:
-    guild: int = guild.id if guild is not None else 0
+def parse_query(name: str) -> Tuple[str, Optional[str]]:
+    """Split a lookup into the casefolded name and the mention to answer with, if any."""
     mention = None # Optional
     if "<@!" in name and ">" in name: # mentioning someone else
         index = name.index("<@!")
@@ -47,8 +73,12 @@ def get_card(guild, name: str) -> Tuple[Optional[List[str]], Optional[List[str]]
     for x in ("@", "#"): # ignore what's after
         if x in name:
             name = name[:name.index(x)]
+    return casefold(name), mention
+
+def get_card(guild, name: str, query: Optional[Tuple[str, Optional[str]]] = None) -> Tuple[Optional[List[str]], Optional[List[str]]]:
+    guild: int = guild.id if guild is not None else 0
+    arg, mention = query if query is not None else parse_query(name)
     ass = []
-    arg = casefold(name)
     possible = set()
     for func, mapping in content_dicts:
         for key, val in mapping.items():
@@ -99,6 +129,61 @@ def complete_match(string: str, matches: Iterable[str]) -> list:
             possible_matches.add(possible)
     return sorted(possible_matches)
 
+def build_router(names: Iterable[str], base: Iterable[str] = (), exact: Iterable[str] = (),
+                 content: Iterable[str] = ()) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Map every part of a command name that complete_match would resolve to one command, to it.
+
+    The names in base are routed exactly as complete_match over them alone would. Of
+    the others, those in exact are only routed to when typed in full, and a partial
+    route that starts any of the (casefolded) content names goes in the second table,
+    only to be used when the lookup finds nothing.
+    """
+    names = list(names)
+    base = set(base)
+    base = [name for name in names if name in base]
+    exact = set(exact)
+    content = sorted(content)
+    routes = {}
+    fallbacks = {}
+    for key, values in _partial_names(base).items():
+        if len(values) == 1:
+            routes[key] = values.pop()
+    for key, values in _partial_names(names).items():
+        if key in routes or len(values) != 1:
+            continue
+        name = values.pop()
+        if name in exact:
+            continue
+        folded = casefold(key)
+        i = bisect.bisect_left(content, folded)
+        if i < len(content) and content[i].startswith(folded):
+            fallbacks[key] = name
+        else:
+            routes[key] = name
+    for name in names: # an exact match always wins
+        routes[name] = name
+    return routes, fallbacks
+
+def _partial_names(names: Iterable[str]) -> Dict[str, set]:
+    candidates = {} # type: Dict[str, set]
+    for name in names:
+        for i in range(len(name)):
+            for j in range(i + 1, len(name) + 1):
+                candidates.setdefault(name[i:j], set()).add(name)
+    return candidates
+
+def find_mage(guild, name: str) -> Tuple[Optional[dict], str]:
+    """Find the one mage matching name, or explain why there isn't one."""
+    guild: int = guild.id if guild is not None else 0
+    possible = {key: [x for x in values if x["guild"] in (0, guild)] for key, values in player_mats.items()}
+    matches = complete_match(casefold(name), [key for key, values in possible.items() if values])
+    if not matches:
+        return None, f"No mage found matching {name}"
+    mats = [x for key in matches for x in possible[key]]
+    if len(mats) > 1:
+        return None, f"Ambiguous value. Possible matches: {', '.join(x['name'] for x in mats)}"
+    return mats[0], ""
+
 # Create the randomizer and its parser
 
 class ArgParser(argparse.ArgumentParser):
@@ -124,155 +209,322 @@ _randomizer_args.add_argument("--force-cheap-gem", "-c", action="store_true", he
 _randomizer_args.add_argument("--relic-count", "-r", type=int, default=2, choices=range(10), help="How many relics to include in the market")
 _randomizer_args.add_argument("--spell-count", "-s", type=int, default=4, choices=range(10), help="How many spells to include in the market")
 
+_randomizer_args.add_argument("--upgraded-basics", "-u", action="store_true", help="Also use upgraded basic nemesis cards when building the basic nemesis deck")
+
 _randomizer_args.add_argument("--lowest-difficulty", "-d", type=int, default=1, choices=range(11), help="The lowest nemesis difficulty to allow")
 _randomizer_args.add_argument("--highest-difficulty", "-D", type=int, default=10, choices=range(11), help="The highest nemesis difficulty to allow")
 
 _randomizer_args.add_argument("--minimum-rating", "-m", type=int, default=1, choices=range(11), help="The minimum mage complexity rating to allow")
 _randomizer_args.add_argument("--maximum-rating", "-M", type=int, default=10, choices=range(11), help="The maximum complexity rating to allow")
 
-#_randomizer_args.add_argument("--expedition", "-e", action="store_true", help="If set, will generate an expedition of length specified in --expedition-length")
-#_randomizer_args.add_argument("--expedition-length", "-E", type=int, default=4, choices=range(1, 9), help="How many battles the expedition should be")
+_randomizer_args.add_argument("--expedition", "-e", action="store_true", help="If set, will generate an expedition of length specified in --expedition-length")
+_randomizer_args.add_argument("--expedition-length", "-E", type=int, default=4, choices=range(1, 9), help="How many battles the expedition should be")
 
-#_randomizer_args.add_argument("--boxes", "-b", action="extend", default=waves, choices=waves, help="From which boxes should the content be pulled")
+_randomizer_args.add_argument("--boxes", "-b", nargs="+", default=[], metavar="USER", help="Pull content from the boxes registered by these users (mentions) with " +
+                               f"{config.prefix}collection, or 'all' for everything. Defaults to your own boxes if you registered any")
+
+_randomizer_args.add_argument("--count", "-n", type=int, default=1, choices=range(1, 51), metavar="N", help="How many setups to generate (1-50)")
+_randomizer_args.add_argument("--seed", "-S", type=int, default=None, help="Seed to reproduce a previous set of setups with")
 
 _randomizer_args.add_argument("--verbose", "-v", action="count", default=0, help="Turn on verbose output (up to -vvv)")
 
-def _isin(code: str, *items: str) -> bool:
-    """Temporary hack until the parser is functional."""
-    for item in items:
-        if f"{item}=" in code:
-            return True
-    return False
+# how many basic nemesis cards of tier 1, 2 and 3 go in the nemesis deck, by player count
+_basic_counts = {1: (1, 3, 7), 2: (3, 5, 7), 3: (5, 6, 7), 4: (8, 7, 7)}
+
+def _randomizer_pools(namespace: argparse.Namespace, boxes: Iterable[str]) -> dict:
+    """Collect every valid choice for each category from the load-time histograms."""
+    pools = {"nemeses": [], "mages": [], "G": [], "R": [], "S": [], "cheap": [], "battles": {}, "basics": {1: [], 2: [], 3: []}}
+    boxes = set(boxes)
+    categories = ("B", "U", "E") if namespace.upgraded_basics else ("B",)
+    seen = set()
+    for box in waves: # keep the same order every time
+        if box not in boxes:
+            continue
+        for tier, cards in basic_index.get(box, {}).items():
+            if tier not in pools["basics"]:
+                continue
+            for category in categories:
+                for card in cards.get(category, ()):
+                    if card["name"] not in seen: # reprints
+                        seen.add(card["name"])
+                        pools["basics"][tier].append(card)
+    for battle, values in expedition_index.items():
+        seen = set()
+        pool = pools["battles"][battle] = []
+        for value in values: # already sorted by difficulty
+            if value["box"] in boxes and value["name"] not in seen and \
+                    namespace.lowest_difficulty <= value["difficulty"] <= namespace.highest_difficulty:
+                seen.add(value["name"])
+                pool.append(value)
+    for box in boxes:
+        for difficulty, values in nemesis_index.get(box, {}).items():
+            if namespace.lowest_difficulty <= difficulty <= namespace.highest_difficulty:
+                pools["nemeses"].extend(values)
+        for rating, values in mage_index.get(box, {}).items():
+            if namespace.minimum_rating <= rating <= namespace.maximum_rating:
+                pools["mages"].extend(values)
+        for ctype, costs in market_index.get(box, {}).items():
+            for cost, values in costs.items():
+                pools[ctype].extend(values)
+                if ctype == "G" and cost <= 3:
+                    pools["cheap"].extend(values)
+    return pools
+
+def _expedition_battles(length: int) -> List[int]:
+    """Return which nemesis battle number to use for each battle of the expedition."""
+    top = max(expedition_index, default=0)
+    return [max(1, math.ceil(i * top / length)) for i in range(1, length + 1)]
+
+def _fingerprint(boxes: Iterable[str]) -> str:
+    return hashlib.sha1("\n".join(sorted(boxes)).encode("utf-8")).hexdigest()[:12]
+
+_max_cached_pools = 256
+
+def _cached_pools(namespace: argparse.Namespace, boxes: Iterable[str]) -> Tuple[str, dict, bool]:
+    """Return the candidate pools for this collection, filtering only the first time it's seen."""
+    fingerprint = _fingerprint(boxes)
+    key = (fingerprint, namespace.lowest_difficulty, namespace.highest_difficulty, namespace.minimum_rating,
+           namespace.maximum_rating, namespace.upgraded_basics)
+    pools = randomizer_cache.pop(key, None)
+    cached = pools is not None
+    if not cached:
+        pools = _randomizer_pools(namespace, boxes)
+        if len(randomizer_cache) >= _max_cached_pools: # drop the least recently used one
+            del randomizer_cache[next(iter(randomizer_cache))]
+    randomizer_cache[key] = pools
+    return fingerprint, pools, cached
+
+def _selected_boxes(ctx: Optional[Context], users: List[str]) -> Tuple[Optional[List[str]], str]:
+    """Figure out which boxes the randomizer may use, and how to describe them."""
+    if "all" in users:
+        return list(waves), "Using ALL released content"
+    ids = []
+    for user in users:
+        user = user.strip("<@!>")
+        if not user.isdigit():
+            return None, f"Could not understand {user!r}, mention users or use 'all'"
+        ids.append(int(user))
+    if not ids and ctx is not None and ctx.author is not None:
+        ids.append(ctx.author.id)
+
+    boxes = set()
+    for user in ids:
+        owned = get_boxes(user)
+        if owned is None and users: # explicitly asked for
+            return None, f"<@{user}> has not registered their boxes (see `{config.prefix}collection`)"
+        if owned is not None:
+            boxes.update(owned)
+    if not boxes:
+        return list(waves), f"Using ALL released content (register your boxes with `{config.prefix}collection`)"
+    boxes = [x for x in waves if x in boxes] # drop boxes that no longer exist
+    return boxes, f"Using content from {len(boxes)} box(es)"
+
+def _randomizer_problems(namespace: argparse.Namespace, pools: dict) -> List[str]:
+    """Return why the settings cannot be satisfied, if they can't."""
+    problems = []
+    mages = namespace.player_count
+    if namespace.expedition:
+        mages *= namespace.expedition_length
+        battles = _expedition_battles(namespace.expedition_length)
+        for battle in sorted(set(battles)):
+            needed = battles.count(battle)
+            if len(pools["battles"].get(battle, ())) < needed:
+                problems.append(f"Could not find enough battle {battle} nemeses ({needed} needed, " +
+                                f"{len(pools['battles'].get(battle, ()))} available)")
+    elif not pools["nemeses"]:
+        problems.append("Could not find a matching nemesis")
+    if len(pools["mages"]) < mages:
+        problems.append(f"Could not find enough mages ({mages} needed, {len(pools['mages'])} available)")
+    for name, ctype, needed in (("gems", "G", namespace.gem_count), ("relics", "R", namespace.relic_count), ("spells", "S", namespace.spell_count)):
+        if len(pools[ctype]) < needed:
+            problems.append(f"Could not find enough market {name} ({needed} needed, {len(pools[ctype])} available)")
+    if namespace.force_cheap_gem and namespace.gem_count and not pools["cheap"]:
+        problems.append("Could not find a gem costing 3 or less")
+    for tier, needed in enumerate(_basic_counts[namespace.player_count], 1):
+        if len(pools["basics"][tier]) < needed:
+            problems.append(f"Could not find enough tier {tier} basic nemesis cards ({needed} needed, {len(pools['basics'][tier])} available)")
+    return problems
+
+def _randomizer_total(namespace: argparse.Namespace, pools: dict) -> int:
+    """Count how many distinct setups match the settings."""
+    gems = math.comb(len(pools["G"]), namespace.gem_count)
+    if namespace.force_cheap_gem and namespace.gem_count:
+        gems -= math.comb(len(pools["G"]) - len(pools["cheap"]), namespace.gem_count)
+    return (len(pools["nemeses"]) * math.comb(len(pools["mages"]), namespace.player_count) * gems *
+            math.comb(len(pools["R"]), namespace.relic_count) * math.comb(len(pools["S"]), namespace.spell_count))
+
+def _random_setup(namespace: argparse.Namespace, pools: dict, rng: random.Random, nemesis=None, mages=None) -> dict:
+    """Pick one battle setup out of the candidate pools."""
+    if nemesis is None:
+        nemesis = rng.choice(pools["nemeses"])
+    if mages is None:
+        mages = rng.sample(pools["mages"], namespace.player_count)
 
-@command("random")
-async def random_cmd(ctx: Context, *args):
-    # TODO: Add expedition support
-    try:
-        namespace = _randomizer_args.parse_args(args)
-    except (argparse.ArgumentError, RuntimeError) as e:
-        await ctx.send(str(e))
-        return
+    gems = []
+    candidates = pools["G"]
+    if namespace.force_cheap_gem and namespace.gem_count:
+        gems.append(rng.choice(pools["cheap"]))
+        candidates = [x for x in candidates if x is not gems[0]]
+    gems.extend(rng.sample(candidates, namespace.gem_count - len(gems)))
+    relics = rng.sample(pools["R"], namespace.relic_count)
+    spells = rng.sample(pools["S"], namespace.spell_count)
+
+    gems.sort(key=lambda x: x["cost"])
+    relics.sort(key=lambda x: x["cost"])
+    spells.sort(key=lambda x: x["cost"])
+
+    basics = [rng.sample(pools["basics"][tier], needed) for tier, needed in enumerate(_basic_counts[namespace.player_count], 1)]
+
+    return {"nemesis": nemesis, "mages": mages, "gems": gems, "relics": relics, "spells": spells, "basics": basics}
 
-    verbose = namespace.verbose
+def _random_expedition(namespace: argparse.Namespace, pools: dict, rng: random.Random) -> List[dict]:
+    """Pick a full expedition, with no nemesis or mage showing up twice."""
+    battles = _expedition_battles(namespace.expedition_length)
+    nemeses = []
+    for battle in sorted(set(battles)):
+        pool = pools["battles"][battle]
+        # the pool is sorted by difficulty, so keep that order to have the expedition escalate
+        picks = sorted(rng.sample(range(len(pool)), battles.count(battle)))
+        nemeses.extend(pool[i] for i in picks)
 
-    # TODO: Allow users to add and select which boxes they have (probably a SQL db or something)
+    count = namespace.player_count
+    mages = rng.sample(pools["mages"], count * len(battles))
 
-    if verbose >= 1:
-        await ctx.send(f"Settings: {namespace}")
+    return [_random_setup(namespace, pools, rng, nemesis, mages[i*count:(i+1)*count]) for i, nemesis in enumerate(nemeses)]
 
-    message = ["Random battle:", ""]
+def _render_setup(setup: dict) -> List[str]:
+    message = [f"Fighting {setup['nemesis']['name']} (difficulty {setup['nemesis']['difficulty']})"]
+    message.append(f"Using mages {', '.join(m['name'] for m in setup['mages'])}")
+
+    for name in ("gems", "relics", "spells"):
+        message.append("")
+        message.append(f"Market {name}:")
+        message.extend([f"{value['name']} (from {value['box']}, {value['cost']}-cost)" for value in setup[name]])
 
-    # TODO: Add box handling (and make sure that there's enough mages/markets/etc.)
-    boxes = list(waves)
-    message.append("Using ALL released content (currently not configurable, will be in the future)")
     message.append("")
+    message.append("Basic nemesis deck:")
+    for tier, cards in enumerate(setup["basics"], 1):
+        message.append(f"Tier {tier}: {', '.join(x['name'] for x in cards)}")
 
-    nemesis = None
-    count = 0
-    while nemesis is None:
-        count += 1
-        if count == 1000:
-            await ctx.send("Could not find a matching nemesis")
-            return
-        values = random.choice(list(nemesis_mats.values()))
-        value = random.choice(values)
-        if verbose >= 2:
-            await ctx.send(f"Checking {value['name']}")
-        if not (namespace.lowest_difficulty <= value["difficulty"] <= namespace.highest_difficulty):
-            if verbose >= 3:
-                await ctx.send("Difficulty doesn't match")
-            continue
-        if "NOEXP" in value["code"]:
-            continue
-        if value["box"] not in boxes:
-            if verbose >= 3:
-                await ctx.send("Box doesn't match")
-            continue
-        nemesis = value
+    return message
 
-    message.append(f"Fighting {nemesis['name']} (difficulty {nemesis['difficulty']})")
+class _Trace:
+    """Verbose output of the randomizer, collected and sent in one go."""
 
-    mages = []
-    count = 0
-    while len(mages) < namespace.player_count:
-        count += 1
-        if count == 1000:
-            await ctx.send("Could not find enough mages")
+    def __init__(self, level: int):
+        self.level = level
+        self.lines = [] # type: List[str]
+        self.stages = [] # type: List[Tuple[str, float, str]]
+        self._last = time.perf_counter()
+
+    def log(self, level: int, line: str) -> None:
+        if self.level >= level:
+            self.lines.append(line)
+
+    def stage(self, name: str, **counts: int) -> None:
+        """Close the current stage, recording how long it took since the previous one."""
+        now = time.perf_counter()
+        self.stages.append((name, (now - self._last) * 1000, ", ".join(f"{k}={v}" for k, v in counts.items())))
+        self._last = now
+
+    async def send(self, ctx: Context) -> None:
+        if not self.level:
             return
-        values = random.choice(list(player_mats.values()))
-        value = random.choice(values)
-        if value in mages:
-            if verbose >= 3:
-                await ctx.send(f"Found {value['name']} but already in, skipping")
-            continue
-        if verbose >= 2:
-            await ctx.send(f"Checking {value['name']}")
-        if not (namespace.minimum_rating <= value["rating"] <= namespace.maximum_rating):
-            if verbose >= 3:
-                await ctx.send("Complexity rating doesn't match")
-            continue
-        if value["box"] not in boxes:
-            if verbose >= 3:
-                await ctx.send("Box doesn't match")
-            continue
+        result = list(self.lines)
+        if self.stages:
+            result.extend(["", "Stage        Time (ms)  Counts"])
+            result.extend(f"{name:<12} {elapsed:>9.3f}  {counts}" for name, elapsed, counts in self.stages)
+        content = "\n".join(result)
+        if len(content) <= 1900:
+            await ctx.send(f"```\n{content}\n```")
+        else:
+            await ctx.send("Randomizer trace:", file=discord.File(io.BytesIO(content.encode("utf-8")), filename="random_trace.txt"))
+
+def _generate_setups(namespace: argparse.Namespace, pools: dict, rng: random.Random, trace: _Trace, message: List[str], count: int) -> int:
+    """Generate the setups into message, splitting it every 1800 characters; returns how many were made."""
+    generated = 0
+    for i in range(namespace.count):
+        if namespace.expedition:
+            setups = _random_expedition(namespace, pools, rng)
+            title = "Random expedition:" if namespace.count == 1 else f"Random expedition #{i+1}:"
+        else:
+            setups = [_random_setup(namespace, pools, rng)]
+            title = "Random battle:" if namespace.count == 1 else f"Random battle #{i+1}:"
+        for j, setup in enumerate(setups, 1):
+            generated += 1
+            trace.log(2, f"Setup {generated}: {setup['nemesis']['name']} with {', '.join(m['name'] for m in setup['mages'])}")
+            lines = [""]
+            if j == 1:
+                lines.extend([title, ""])
+            if namespace.expedition:
+                lines.extend([f"Battle {j}:", ""])
+            lines.extend(_render_setup(setup))
+            length = sum(len(x) + 1 for x in lines)
+            if count + length >= 1800:
+                message.append(r"\NEWLINE/")
+                count = 0
+            message.extend(lines)
+            count += length
+    return generated
 
-        mages.append(value)
+@command("random")
+async def random_cmd(ctx: Context, *args):
+    try:
+        namespace = _randomizer_args.parse_args(args)
+    except (argparse.ArgumentError, RuntimeError) as e:
+        await ctx.send(str(e))
+        return
 
-    message.append(f"Using mages {', '.join(m['name'] for m in mages)}")
+    trace = _Trace(namespace.verbose)
+    trace.log(1, f"Settings: {namespace}")
+    trace.stage("parse")
 
-    # Note: this block below checks the code column in a very hacky way
-    # This is going to be improved when the parser is complete
+    boxes, using = _selected_boxes(ctx, namespace.boxes)
+    if boxes is None:
+        await ctx.send(using)
+        return
+    trace.log(2, f"Boxes: {', '.join(boxes)}")
+    trace.stage("boxes", boxes=len(boxes))
+
+    fingerprint, pools, cached = _cached_pools(namespace, boxes)
+    trace.log(2, f"Collection {fingerprint} ({'cached' if cached else 'filtered now'})")
+    for name, key in (("Nemeses", "nemeses"), ("Mages", "mages"), ("Gems", "G"), ("Relics", "R"), ("Spells", "S")):
+        trace.log(3, f"{name}: {', '.join(x['name'] for x in pools[key])}")
+    for tier, cards in pools["basics"].items():
+        trace.log(3, f"Tier {tier} basics: {', '.join(x['name'] for x in cards)}")
+    trace.stage("pools", cached=int(cached), nemeses=len(pools["nemeses"]), mages=len(pools["mages"]),
+                gems=len(pools["G"]), cheap_gems=len(pools["cheap"]), relics=len(pools["R"]), spells=len(pools["S"]),
+                basics=sum(len(x) for x in pools["basics"].values()))
+
+    problems = _randomizer_problems(namespace, pools)
+    trace.stage("feasibility", problems=len(problems))
+    if problems:
+        await trace.send(ctx)
+        await ctx.send("Impossible settings:\n" + "\n".join(problems))
+        return
 
-    gems = []
-    relics = []
-    spells = []
-    count = 0
-    while len(gems) < namespace.gem_count or len(relics) < namespace.relic_count or len(spells) < namespace.spell_count:
-        count += 1
-        if count == 5000:
-            await ctx.send("Could not find enough market cards")
-            return
-        for value in random.choice(list(player_cards.values())):
-            if value["type"] == "G":
-                if not gems and namespace.force_cheap_gem and value["cost"] > 3:
-                    continue
-                if len(gems) >= namespace.gem_count:
-                    continue
-                if value["starter"]:
-                    continue
-                if _isin(value["code"], "T", "U", "N"):
-                    continue
-                if value not in gems:
-                    gems.append(value)
-            if value["type"] == "R":
-                if len(relics) >= namespace.relic_count:
-                    continue
-                if value["starter"]:
-                    continue
-                if _isin(value["code"], "T", "U", "N"):
-                    continue
-                if value not in relics:
-                    relics.append(value)
-            if value["type"] == "S":
-                if len(spells) >= namespace.spell_count:
-                    continue
-                if value["starter"]:
-                    continue
-                if _isin(value["code"], "T", "U", "N"):
-                    continue
-                if value not in spells:
-                    spells.append(value)
+    if namespace.expedition:
+        battles = _expedition_battles(namespace.expedition_length)
+        trace.log(1, f"Expedition battles use nemeses from battles {', '.join(str(x) for x in battles)}; candidates: " +
+                     ", ".join(f"{len(pools['battles'].get(x, ()))} for battle {x}" for x in sorted(set(battles))))
+    else:
+        trace.log(1, f"{_randomizer_total(namespace, pools)} possible setups")
 
-    gems.sort(key=lambda x: x["cost"])
-    relics.sort(key=lambda x: x["cost"])
-    spells.sort(key=lambda x: x["cost"])
+    seed = namespace.seed
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    rng = random.Random(seed)
 
-    for name, container in (("gems", gems), ("relics", relics), ("spells", spells)):
-        message.append("")
-        message.append(f"Market {name}:")
-        message.extend([f"{value['name']} (from {value['box']}, {value['cost']}-cost)" for value in container])
+    message = [using]
+    message.append(f"Seed: {seed} (use `{config.prefix}random --seed {seed}` with the same settings to get these again)")
+    count = len(message[0]) + len(message[1])
 
-    await ctx.send("\n".join(message))
+    generated = await run_cpu(_generate_setups, namespace, pools, rng, trace, message, count)
+    trace.stage("generate", setups=generated)
+
+    await trace.send(ctx)
+    for msg in "\n".join(message).split(r"\NEWLINE/"):
+        await ctx.send(msg)
 
 @command()
 async def info(ctx: Context, *args):
@@ -283,7 +535,9 @@ async def info(ctx: Context, *args):
     if not arg.isalpha() and arg.isalnum(): # has numbers and no special characters
         await ctx.send(f"Number detected. Did you want `{config.prefix}card` instead?")
         return
-    values, asset = get_card(ctx.guild, arg)
+    guild = ctx.guild.id if ctx.guild is not None else 0
+    query = parse_query(arg)
+    values, asset = await coalesce(("card", guild, query), run_cpu, get_card, ctx.guild, arg, query)
     if values and values[0] is None: # too many values
         to_send = f"Ambiguous value. Possible matches: {', '.join(values[1:])}"
     elif not values:
@@ -294,111 +548,177 @@ async def info(ctx: Context, *args):
     for msg in to_send.split(r"\NEWLINE/"):
         await ctx.send(msg)
     for ass in asset:
-        with open(os.path.join("assets", ass), mode="rb") as a:
-            await ctx.send(file=discord.File(a))
+        await send_asset(ctx, ass)
 
-@command()
-async def card(ctx: Context, *args):
-    await ctx.send(card_(casefold("".join(args)).upper(), detailed=True))
+_card_types = {"P": "Player card", "N": "Nemesis card", "T": "Treasure card", "O": "Xaxos: Outcast Ability"}
+
+# how many cards a single !card may ask for
+_max_card_ids = 100
+
+def _card_range(arg: str) -> List[Tuple[str, int]]:
+    """Parse a single ID, or a range such as 1a10-1a20 or 1a10-20, into (head, number) pairs."""
+    for i, x in enumerate(arg):
+        if x != "-":
+            continue
+        start, end = split_card_id(arg[:i]), arg[i+1:]
+        if start is None:
+            continue
+        if end.isdigit():
+            end = (start[0], int(end))
+        else:
+            end = split_card_id(end)
+        if end is not None and end[0] == start[0] and start[1] <= end[1]:
+            return [(start[0], num) for num in range(start[1], end[1] + 1)]
+    single = split_card_id(arg)
+    if single is None:
+        raise ValueError(arg)
+    return [single]
 
 def card_(arg: str, *, detailed=False) -> str:
     if arg.isdigit():
         return "No prefix supplied."
-    index = 0
-    for i, x in enumerate(arg):
-        if x.isdigit():
-            index = i
-            break
-    if not index:
+    if not any(x.isdigit() for x in arg):
         return f"No number found. Did you want `{config.prefix}info` instead?"
-    prefix, num = arg[:index], arg[index:]
-    deck = None
-    if ("I" in prefix or prefix == "V") and "T" not in prefix: # Legacy and not Into the Wild
-        deck = prefix
-        prefix = None
-    if not num.isdigit(): # probably has a deck in it, like 1a
-        if num[0].isdigit() and num[1].isalpha() and num[2:].isdigit():
-            deck, num = num[:2], num[2:]
-    if prefix not in cards_num:
-        return f"Prefix {prefix} is unrecognized"
-    values = cards_num[prefix]
-    # this is a hack
-    if deck and len(deck) == 2 and deck[1] in "ABCD":
-        deck = deck[0] + deck[1].lower()
-    if deck not in values:
-        return f"Deck {deck} not recognized"
-    num = int(num)
-    if num not in values[deck]:
-        return f"Card {num} is unknown"
-
-    ctype, name = values[deck][num]
+    ids = split_card_id(arg)
+    found = find_card_ids(*ids) if ids else []
+    if not found:
+        return f"Card {arg} is unknown"
     if not detailed:
-        return name
-
-    if ctype == "P":
-        ctype = "Player card"
-    elif ctype == "N":
-        ctype = "Nemesis card"
-    elif ctype == "T":
-        ctype = "Treasure card"
-    elif ctype == "O":
-        ctype = "Xaxos: Outcast Ability"
-    else:
-        ctype = "Unknown card type"
-
-    return f"{name} ({ctype})"
+        return " / ".join(name for printed, ctype, name in found)
+    if len(found) == 1:
+        return f"{found[0][2]} ({_card_types.get(found[0][1], 'Unknown card type')})"
+    return "\n".join(f"{printed}: {name} ({_card_types.get(ctype, 'Unknown card type')})" for printed, ctype, name in found)
 
 @command()
-async def box(ctx: Context, *args):
+async def card(ctx: Context, *args):
     arg = "".join(args)
+    try:
+        single = "," not in arg and len(_card_range(arg)) == 1
+    except ValueError:
+        single = True
+    if single:
+        await ctx.send(card_(arg, detailed=True))
+        return
+
+    lines = []
+    total = 0
+    for item in filter(None, arg.split(",")):
+        try:
+            ids = _card_range(item)
+        except ValueError:
+            lines.append(f"{item}: Card ID not recognized")
+            continue
+        total += len(ids)
+        if total > _max_card_ids:
+            await ctx.send(f"Too many cards requested (at most {_max_card_ids} at once)")
+            return
+        for head, num in ids:
+            found = find_card_ids(head, num)
+            if not found and len(ids) == 1:
+                lines.append(f"{item}: Card is unknown")
+            for printed, ctype, name in found:
+                lines.append(f"{printed}: {name} ({_card_types.get(ctype, 'Unknown card type')})")
+
+    if not lines:
+        await ctx.send("No cards found")
+        return
+    message = []
+    count = 0
+    for line in lines:
+        if count + len(line) >= 1800:
+            message.append(r"\NEWLINE/")
+            count = 0
+        message.append(line)
+        count += len(line) + 1
+    for msg in "\n".join(message).split(r"\NEWLINE/"):
+        await ctx.send(msg)
+
+def _match_box(arg: str) -> Tuple[Optional[str], str]:
     arg = casefold(arg)
     mapping = {casefold(x): x for x in waves}
     values = complete_match(arg, mapping)
     if len(values) > 1:
-        await ctx.send(f"Ambiguous value. Possible matches: {', '.join(values)}")
-        return
+        return None, f"Ambiguous value. Possible matches: {', '.join(values)}"
     if not values:
-        await ctx.send("No match found")
+        return None, "No match found"
+    return mapping[values[0]], ""
+
+@command()
+async def collection(ctx: Context, *args):
+    usage = (f"Usage: `{config.prefix}collection [list]`, `{config.prefix}collection add <box>[, <box>...]`, " +
+             f"`{config.prefix}collection remove <box>[, <box>...]`, `{config.prefix}collection clear`")
+    action = args[0].lower() if args else "list"
+    owned = set(get_boxes(ctx.author.id) or ())
+
+    if action == "list":
+        if not owned:
+            await ctx.send(f"You have not registered any boxes; the randomizer will use everything.\n{usage}")
+        else:
+            await ctx.send("Your boxes:\n- " + "\n- ".join(x for x in waves if x in owned))
         return
 
-    box = mapping[values[0]]
-    prefix = waves[box][0]
-    
-    result = ["```", f"Cards from {box}:", ""]
-    count = len(" ".join(result))
-    c = {"P": player_cards, "N": nemesis_cards, "T": treasure_values, "O": treasure_values}
-
-    for deck in cards_num[prefix]:
-        if count >= 1800:
-            result.append("```\\NEWLINE/```")
-            count = 3
-        if deck and deck != "Promo": # promo cards do their own thing
-            result.extend([f"```\\NEWLINE/```", f"Deck: {deck}", ""])
-            count = len(deck) + 12
-        for num, (ctype, card) in cards_num[prefix][deck].items():
-            if count >= 1800:
-                result.append("```\\NEWLINE/```")
-                count = 3
-            ind = c[ctype][casefold(card)]
-            for d in ind:
-                if d['box'] != box:
-                    continue
-                if count >= 1800:
-                    result.append("```\\NEWLINE/```")
-                    count = 3
-                result.append(f"- {card} ({ctypes[d['type']]}) ({num})")
-                count += len(result[-1])
+    if action == "clear":
+        set_boxes(ctx.author.id, ())
+        await ctx.send("Your boxes have been cleared.")
+        return
 
-    result.append("```")
+    if action not in ("add", "remove") or len(args) < 2:
+        await ctx.send(usage)
+        return
 
-    for line in "\n".join(result).split("\\NEWLINE/"):
-        await ctx.send(line)
+    changed = []
+    for arg in " ".join(args[1:]).split(","):
+        box, error = _match_box(arg)
+        if box is None:
+            await ctx.send(f"{arg.strip()}: {error}")
+            return
+        changed.append(box)
+
+    if action == "add":
+        owned.update(changed)
+    else:
+        owned.difference_update(changed)
+    set_boxes(ctx.author.id, owned)
+    await ctx.send(f"{'Added' if action == 'add' else 'Removed'} {', '.join(changed)}. You now have {len(owned)} box(es) registered.")
 
 @command()
-async def search(ctx: Context, *args):
-    arg = " ".join(args).lower()
+async def box(ctx: Context, *args):
+    args = list(args)
+    page = 1
+    if len(args) > 1 and args[-1].isdigit():
+        page = int(args.pop())
+
+    ctype = None
+    names = {}
+    for key, name in ctypes.items():
+        names[casefold(name)] = names[casefold(name) + "s"] = key
+    for i in range(1, len(args)): # the card type is at the end, and may be several words
+        if casefold("".join(args[i:])) in names:
+            ctype = names[casefold("".join(args[i:]))]
+            args = args[:i]
+            break
+
+    box, error = _match_box("".join(args))
+    if box is None:
+        await ctx.send(error)
+        return
+
+    pages = box_pages.get(box, {}).get(ctype)
+    if not pages:
+        await ctx.send(f"There are no {ctypes[ctype] + ' ' if ctype else ''}cards in {box}")
+        return
+    if not 1 <= page <= len(pages):
+        await ctx.send(f"There are only {len(pages)} page(s) for {box}")
+        return
+
+    result = pages[page-1]
+    if len(pages) > 1:
+        more = f" Use `{config.prefix}box {' '.join(args)}{' ' + ctypes[ctype] if ctype else ''} <page>` for the others." if page == 1 else ""
+        result += f"\nPage {page}/{len(pages)}.{more}"
+    await ctx.send(result)
+
+def _search(guild: Optional[int], arg: str) -> List[dict]:
     final = []
-    guild = ctx.guild.id if ctx.guild else None
     for mapping, attrs in (
         (player_cards, ("text", "special", "flavour")),
         (nemesis_cards, ("effect", "special", "immediate", "discard", "flavour")),
@@ -419,6 +739,13 @@ async def search(ctx: Context, *args):
                         c = c[second]
                     if arg in c.lower():
                         final.append(inner)
+    return final
+
+@command()
+async def search(ctx: Context, *args):
+    arg = " ".join(args).lower()
+    guild = ctx.guild.id if ctx.guild else None
+    final = await coalesce(("search", guild, arg), run_cpu, _search, guild, arg)
 
     if final:
         await ctx.send(f"Found the following content for pattern `{arg}`:")
@@ -436,6 +763,58 @@ async def search(ctx: Context, *args):
     else:
         await ctx.send(f"Could not find anything matching pattern `{arg}`.")
 
+@command()
+async def related(ctx: Context, *args):
+    arg = casefold("".join(args))
+    if not arg:
+        await ctx.send(f"Usage: `{config.prefix}related <name>`")
+        return
+    guild = ctx.guild.id if ctx.guild is not None else 0
+    keys = set()
+    for mapping in (player_cards, nemesis_cards, treasure_values, player_mats, nemesis_mats):
+        keys.update(key for key, values in mapping.items() if any(x["guild"] in (0, guild) for x in values))
+    keys.update(starter_users) # Crystal and Spark aren't anywhere else
+    matches = complete_match(arg, keys)
+    if len(matches) > config.max_dupes:
+        await ctx.send(f"Ambiguous value. Possible matches: {', '.join(matches)}")
+        return
+    if not matches:
+        await ctx.send(f"No content found matching {' '.join(args)}")
+        return
+
+    result = []
+    for key in matches:
+        lines = []
+        for mat in nemesis_mats.get(key, ()):
+            lines.append(f"{mat['name']} uses: {', '.join(card for ctype, card, content in mat['card_refs'])}")
+        for mat in player_mats.get(key, ()):
+            if mat["starting"] is not None:
+                lines.append(f"{mat['name']} starts with: {', '.join(sorted(set(mat['starting'][0] + mat['starting'][1])))}")
+            for breach in mage_breaches.get(key, ()):
+                lines.append(f"{mat['name']} uses the {breach['name']}")
+        users = [x for x in nemesis_users.get(key, ()) if x["guild"] in (0, guild)]
+        if users:
+            lines.append(f"Used with nemeses: {', '.join(x['name'] for x in users)}")
+        users = [x for x in starter_users.get(key, ()) if x["guild"] in (0, guild)]
+        if users:
+            lines.append(f"Starting card for: {', '.join(x['name'] for x in users)}")
+        if lines:
+            result.extend(lines)
+
+    if not result:
+        await ctx.send("No related content found.")
+        return
+    msg = []
+    l = 0
+    for line in result:
+        if l + len(line) >= 1800 and msg:
+            await ctx.send("```\n" + "\n".join(msg) + "\n```")
+            msg.clear()
+            l = 0
+        msg.append(line[:1800])
+        l += len(msg[-1]) + 1
+    await ctx.send("```\n" + "\n".join(msg) + "\n```")
+
 @command()
 async def unique(ctx: Context, *args):
     await ctx.send("```\nThe unique mechanics that I know about are as follow. " +
@@ -446,9 +825,16 @@ async def unique(ctx: Context, *args):
 async def reload(ctx: Context, *args):
     if await ctx.bot.is_owner(ctx.author):
         print("\nReloading content")
-        load()
+        async with executor.exclusive(): # no lookup is reading the content while it's replaced
+            load()
+        asset_cache.clear()
         await ctx.send("Reloaded data.")
 
+@command()
+async def stats(ctx: Context, *args):
+    if await ctx.bot.is_owner(ctx.author):
+        await ctx.send(f"{executor.report()}\n{outbound.queue.report()}\n{singleflight.report()}")
+
 @command()
 async def issues(ctx: Context, *args):
     content = f"""* Known issues and to-do list *
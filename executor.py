@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, Optional, TypeVar
+import asyncio
+import time
+
+from loader import log
+
+import config
+
+# Pool for the lookup and render work of the commands (get_card, the
+# renderers, !search, the randomizer), so that the event loop keeps up with
+# heartbeats and other messages while a heavy one runs. Threads are used
+# rather than processes since that work reads the loaded content in place;
+# the loop thread still gets its turn at every interpreter switch. Since
+# !reload empties and refills that content, it goes through exclusive(),
+# which waits for the running tasks and holds off new ones until it's done.
+
+_workers = getattr(config, "render_workers", 4)
+# tasks that waited longer than this for a worker are logged, in seconds
+_slow_queue = 0.25
+
+_pool = None # type: Optional[ThreadPoolExecutor]
+# set while no reload is going on, and while no task is running; made again
+# for each event loop, as the harness and the tests run several in turn
+_loop = None # type: Optional[asyncio.AbstractEventLoop]
+_open = None # type: Optional[asyncio.Event]
+_idle = None # type: Optional[asyncio.Event]
+
+# only updated from the event loop
+stats = {"tasks": 0, "running": 0, "queued": 0.0, "max_queued": 0.0, "busy": 0.0}
+
+T = TypeVar("T")
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool, _loop, _open, _idle
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix="render")
+    loop = asyncio.get_running_loop()
+    if _loop is not loop:
+        _loop = loop
+        _open = asyncio.Event()
+        _open.set()
+        _idle = asyncio.Event()
+        _idle.set()
+        stats["running"] = 0
+    return _pool
+
+async def run_cpu(func: Callable[..., T], *args) -> T:
+    """Run func(*args) in the pool and return its result to the calling coroutine."""
+    pool = _get_pool()
+    while not _open.is_set():
+        await _open.wait()
+    submitted = time.perf_counter()
+    times = []
+
+    def task():
+        times.append(time.perf_counter())
+        try:
+            return func(*args)
+        finally:
+            times.append(time.perf_counter())
+
+    def done(future):
+        # runs on the loop once the thread is really done, even if the caller was cancelled
+        stats["running"] -= 1
+        if not stats["running"]:
+            _idle.set()
+        if times:
+            waited = times[0] - submitted
+            stats["tasks"] += 1
+            stats["queued"] += waited
+            stats["max_queued"] = max(stats["max_queued"], waited)
+            stats["busy"] += times[-1] - times[0]
+            if waited > _slow_queue:
+                log(f"{func.__name__} waited {waited*1000:.0f}ms for a worker", level="local")
+
+    stats["running"] += 1
+    _idle.clear()
+    future = asyncio.get_running_loop().run_in_executor(pool, task)
+    future.add_done_callback(done)
+    return await asyncio.shield(future)
+
+@asynccontextmanager
+async def exclusive():
+    """Keep the pool idle for the duration, for work that replaces the loaded content."""
+    _get_pool()
+    while not _open.is_set(): # another reload
+        await _open.wait()
+    _open.clear()
+    try:
+        while not _idle.is_set():
+            await _idle.wait()
+        yield
+    finally:
+        _open.set()
+
+def report() -> str:
+    tasks = stats["tasks"] or 1
+    return (f"Render pool: {_workers} workers, {stats['tasks']} tasks, {stats['running']} running, " +
+            f"queue latency {stats['queued'] / tasks * 1000:.1f}ms average, {stats['max_queued'] * 1000:.1f}ms max, " +
+            f"{stats['busy'] / tasks * 1000:.1f}ms average run time")
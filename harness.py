@@ -0,0 +1,157 @@
+from typing import List, Optional
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import main # loads the content and registers every command
+from loader import log
+
+# Runs requests through the same dispatch as on_message, against a fake
+# context, guild and channel, with no connection to Discord. Requests come
+# from a log of the bot (the "REQ: <content>" lines) or from the command line,
+# and are replayed at the given concurrency and rate; the report has the
+# throughput, latency percentiles and how many messages each request sent.
+# Run with `python harness.py [--log FILE] [--concurrency N] [--rate N] [request ...]`.
+
+class FakeGuild:
+    def __init__(self, id: int):
+        self.id = id
+        self.name = f"Guild {id}"
+
+class FakeChannel:
+    def __init__(self, id: int):
+        self.id = id
+
+class FakeUser:
+    def __init__(self, id: int):
+        self.id = id
+        self.mention = f"<@{id}>"
+
+class FakeAttachment:
+    def __init__(self, url: str):
+        self.url = url
+
+class FakeMessage:
+    def __init__(self, content, kwargs):
+        self.content = content
+        file = kwargs.get("file")
+        self.attachments = [FakeAttachment(f"https://cdn.example/{file.filename}")] if file is not None else []
+
+class FakeBot:
+    def __init__(self, owner: bool):
+        self.owner = owner
+        self.guilds = []
+        self.users = []
+
+    async def is_owner(self, user) -> bool:
+        return self.owner
+
+    def get_user(self, id: int) -> None:
+        return None
+
+class FakeContext:
+    """Stands in for a discord.py Context; records what would have been sent."""
+
+    command = None
+
+    def __init__(self, bot: FakeBot, guild: Optional[FakeGuild], channel: FakeChannel, author: FakeUser):
+        self.bot = bot
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+        return FakeMessage(content, kwargs)
+
+def read_log(path: str) -> List[str]:
+    requests = []
+    with open(path, "rt", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if "REQ: " in line:
+                requests.append(line.split("REQ: ", 1)[1].rstrip("\n"))
+    return requests
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def replay(requests: List[str], concurrency: int = 1, rate: float = 0.0, guild: Optional[int] = None, owner: bool = False) -> dict:
+    """Run the requests, at most concurrency at once and at most rate per second (0 for no limit)."""
+    bot = FakeBot(owner)
+    fake_guild = FakeGuild(guild) if guild else None
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    sends = []
+    errors = []
+
+    async def run(i: int, content: str):
+        async with semaphore:
+            ctx = FakeContext(bot, fake_guild, FakeChannel(i), FakeUser(i))
+            start = time.perf_counter()
+            try:
+                await main.dispatch(ctx, content)
+            except Exception as e:
+                errors.append(f"{content}: {e!r}")
+            latencies.append(time.perf_counter() - start)
+            sends.append(len(ctx.sent))
+
+    start = time.perf_counter()
+    tasks = []
+    for i, content in enumerate(requests):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(run(i, content)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(requests), "concurrency": concurrency, "rate": rate, "seconds": elapsed,
+        "throughput": len(requests) / elapsed if elapsed else 0.0,
+        "latency_ms": {f"p{p}": _percentile(latencies, p) * 1000 for p in (50, 95, 99)},
+        "max_latency_ms": max(latencies, default=0.0) * 1000,
+        "sends": {"total": sum(sends), "mean": sum(sends) / len(sends) if sends else 0.0, "max": max(sends, default=0)},
+        "errors": errors,
+    }
+
+def format_report(result: dict) -> str:
+    latency = result["latency_ms"]
+    values = [
+        f"{result['requests']} requests in {result['seconds']:.2f}s ({result['throughput']:.1f}/s), " +
+        f"concurrency {result['concurrency']}, rate {result['rate'] or 'unlimited'}",
+        f"Latency: p50 {latency['p50']:.2f}ms, p95 {latency['p95']:.2f}ms, p99 {latency['p99']:.2f}ms, max {result['max_latency_ms']:.2f}ms",
+        f"Sends per request: {result['sends']['mean']:.2f} average, {result['sends']['max']} max, {result['sends']['total']} total",
+        f"Errors: {len(result['errors'])}",
+    ]
+    values.extend(f"  {x}" for x in result["errors"][:20])
+    return "\n".join(values)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay requests against the bot without Discord")
+    parser.add_argument("requests", nargs="*", help="Requests to run, as typed after the prefix")
+    parser.add_argument("--log", help="Replay the REQ: lines of this log file")
+    parser.add_argument("--concurrency", "-c", type=int, default=1, help="How many requests to run at once")
+    parser.add_argument("--rate", "-r", type=float, default=0.0, help="How many requests to start per second (0 for no limit)")
+    parser.add_argument("--repeat", "-n", type=int, default=1, help="Replay the requests this many times")
+    parser.add_argument("--guild", "-g", type=int, help="Run the requests in this guild, for its overlay")
+    parser.add_argument("--owner", action="store_true", help="Run the requests as the owner")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+
+    requests = list(args.requests)
+    if args.log:
+        requests.extend(read_log(args.log))
+    if not requests:
+        sys.exit("Nothing to replay")
+    result = asyncio.run(replay(requests * args.repeat, args.concurrency, args.rate, args.guild, args.owner))
+    if args.json:
+        print(json.dumps(result, indent=1))
+    else:
+        log(format_report(result), level="local")
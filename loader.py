@@ -1,7 +1,11 @@
-from typing import Dict, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 from collections import defaultdict
+from bisect import bisect_left
 import csv
+import hashlib
 import os
+import pickle
+import re
 
 from code_parser import parse
 
@@ -31,6 +35,67 @@ nemesis_mats = defaultdict(list)
 breach_values = defaultdict(list)
 treasure_values = defaultdict(list)
 
+# bumped on every (re)load, for caches of anything derived from the content
+generation = 0
+
+# cross-references between content, rebuilt on every (re)load
+# forward edges are stored on the records themselves: "card_refs" on nemesis mats,
+# "starting" on player mats and "mage_mat" on breaches; reverse edges are below
+nemesis_users = defaultdict(list) # casefolded card name -> nemesis mats using it
+starter_users = defaultdict(list) # casefolded card name -> player mats starting with it
+mage_breaches = defaultdict(list) # casefolded mage name -> their special breaches
+
+# card ID grammar, rebuilt on every (re)load
+# a printed ID is a wave prefix, a deck and a number, such as "AE55", "NA-1a-10"
+# or "VIII25"; IDs are matched in uppercase with the dashes left out
+# normalised head (prefix and deck) -> number -> [(printed ID, card type, name)]
+card_ids = {} # type: Dict[str, Dict[int, List[Tuple[str, str, str]]]]
+# same, for IDs given without their wave prefix, such as "1a10"
+deck_ids = {} # type: Dict[str, Dict[int, List[Tuple[str, str, str]]]]
+_card_id_re = re.compile("(?!)") # head followed by the number, over every known head
+_wave_grammars = {} # type: Dict[Optional[str], Tuple[re.Pattern, Dict[str, Optional[str]]]]
+
+# compiled unique mechanics, kept across reloads so that only the files that changed
+# (or whose card references did) are compiled again
+# filename -> ((mtime, size), card ID -> resolved name, message lines)
+_unique_cache = {} # type: Dict[str, Tuple[Tuple[int, int], Dict[str, str], List[str]]]
+
+# box listings, rebuilt on every (re)load
+# box -> card type (None for all of them) -> ready-made pages for !box
+box_pages = {} # type: Dict[str, Dict[Optional[str], List[str]]]
+
+# autocomplete prefix index, rebuilt on every (re)load
+# guild (0 for everyone) -> kind ("card", "mat", "box" or "mechanic") -> sorted (casefolded name, name)
+autocomplete_index = {} # type: Dict[int, Dict[str, List[Tuple[str, str]]]]
+
+# randomizer histograms, rebuilt on every (re)load
+# box -> type -> cost -> cards
+market_index = {} # type: Dict[str, Dict[str, Dict[int, List[dict]]]]
+# box -> difficulty -> nemeses
+nemesis_index = {} # type: Dict[str, Dict[int, List[dict]]]
+# box -> complexity rating -> mages
+mage_index = {} # type: Dict[str, Dict[int, List[dict]]]
+# box -> tier -> category -> basic nemesis cards
+basic_index = {} # type: Dict[str, Dict[int, Dict[str, List[dict]]]]
+# expedition battle -> nemeses, sorted by difficulty
+expedition_index = {} # type: Dict[int, List[dict]]
+# (collection fingerprint, settings) -> randomizer candidate pools
+randomizer_cache = {} # type: Dict[tuple, dict]
+
+# everything that load() fills, as saved to a prebuilt catalog
+_catalog_names = (
+    "assets", "waves", "cards_num", "ctypes", "ability_types", "mechanics", "player_cards", "nemesis_cards",
+    "player_mats", "nemesis_mats", "breach_values", "treasure_values", "nemesis_users", "starter_users",
+    "mage_breaches", "card_ids", "deck_ids", "_wave_grammars", "_unique_cache", "box_pages", "market_index",
+    "nemesis_index", "mage_index", "basic_index", "expedition_index", "autocomplete_index",
+)
+# bump when the layout of the loaded content changes
+_catalog_version = 2
+
+_market_types = ("G", "R", "S")
+# basic, upgraded basic and fully-evolved Legacy basic nemesis cards
+_basic_categories = ("B", "U", "E")
+
 class _open:
     """Wrapper class to get around weird encoding shenanigans."""
 
@@ -150,15 +215,99 @@ def load_meta(relpath=None):
     load_ctypes(relpath)
     load_atypes(relpath)
 
+def _card_ref(item: str) -> str:
+    ids = split_card_id(item)
+    found = find_card_ids(*ids) if ids else []
+    if not found:
+        return f"Card {item} is unknown"
+    return " / ".join(name for printed, ctype, name in found)
+
+class _CardRefs:
+    """Resolve {card[...]} in the unique mechanics, remembering what was looked up."""
+
+    def __init__(self):
+        self.refs = {} # type: Dict[str, str]
+
+    def __getitem__(self, item: str) -> str:
+        self.refs[item] = _card_ref(item)
+        return self.refs[item]
+
+def compile_mechanic(mechanic: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    """Turn a .lexive file into its message lines, and the card references it used."""
+    cards = _CardRefs()
+    def preformat(x: str) -> str:
+        return x.format(prefix=config.prefix, newline="", card=cards)
+
+    values = []
+    if len(mechanic) == 1: # most common occurence
+        values.append("```")
+        values.append(preformat(mechanic[0].rstrip("\n")))
+        values.append("```")
+        return values, cards.refs
+
+    # manually go through
+    is_title = False
+    is_continue = False
+    continuing = False
+    for current in mechanic:
+        current = current.rstrip("\n")
+        if not current:
+            if continuing:
+                values.append("```")
+                continuing = False
+            continue
+        if current == "TITLE":
+            is_title = True
+            continue
+        if current == "CONTINUE":
+            is_continue = True
+            continue
+        if current == "NEXT":
+            values.append(r"\NEWLINE/")
+            continue
+        if is_title:
+            values.append(preformat(current))
+            is_title = False
+            continue
+        if continuing:
+            values.append(preformat(current))
+            continue
+
+        if values and not is_continue:
+            values.append(r"\NEWLINE/")
+        values.append("```")
+        values.append(preformat(current))
+        continuing = True
+        is_continue = False
+
+    if continuing:
+        values.append("```")
+
+    return values, cards.refs
+
 def load_unique():
+    # needs the card IDs, to resolve the card references
     mechanics.clear()
+    compiled = 0
     for filename in os.listdir("unique"):
         if not filename.endswith(".lexive"):
             continue
-        with open(os.path.join("unique", filename), "rt") as unique_file:
-            mechanics[filename[:-7]].append({"name": filename[:-7], "content": unique_file.readlines()})
-
-    log("Mechanics loaded", level="local")
+        path = os.path.join("unique", filename)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = _unique_cache.get(filename)
+        if cached is None or cached[0] != key or any(_card_ref(x) != name for x, name in cached[1].items()):
+            with open(path, "rt") as unique_file:
+                lines, refs = compile_mechanic(unique_file.readlines())
+            cached = _unique_cache[filename] = (key, refs, lines)
+            compiled += 1
+        mechanics[filename[:-7]].append({"name": filename[:-7], "content": cached[2]})
+
+    for filename in list(_unique_cache):
+        if filename[:-7] not in mechanics:
+            del _unique_cache[filename]
+
+    log(f"Mechanics loaded ({compiled} compiled)", level="local")
 
 def load_pcards(relpath=None):
     file = "player_cards.csv"
@@ -268,6 +417,25 @@ def load_pmats(relpath=None):
 
     log("Player mats loaded", level="local")
 
+def starting_cards(mat: dict) -> Tuple[List[str], List[str]]:
+    """Resolve a mage's starting hand and deck codes into card names."""
+    wave = waves[mat["box"]][0]
+    hand = []
+    deck = []
+    for orig, new in zip((mat["hand"], mat["deck"]), (hand, deck)):
+        for x in orig:
+            if x == "C":
+                x = "Crystal"
+            elif x == "S":
+                x = "Spark"
+            else:
+                try:
+                    x = resolve_card_id(x, wave)[1]
+                except ValueError as e:
+                    x = f"ERROR: {e}"
+            new.append(x)
+    return hand, deck
+
 def load_nmats(relpath=None):
     file = "nemesis_mats.csv"
     if relpath is None:
@@ -291,6 +459,42 @@ def load_nmats(relpath=None):
 
     log("Nemesis mats loaded", level="local")
 
+def breach_plans(breach: dict) -> List[List[Optional[Tuple[int, List[str]]]]]:
+    """Cheapest way to turn a breach from one orientation to another, for every pair.
+
+    Orientations are 0 (open), 1 (up), 2 (left), 3 (down) and 4 (right). Focusing
+    turns a closed breach one step closer to open, and opening can be done from
+    any closed orientation; a cost of 0 means that action isn't possible. The result
+    is indexed as [start][target] and is None when the target can't be reached.
+    On ties, the plan with more focuses wins, since each focus also gives a charge.
+    """
+    open_costs = (0, breach["focus"], breach["left"], breach["down"], breach["right"])
+    # best[o] is the cheapest way to open the breach from orientation o
+    best = [(0, [])] # type: List[Optional[Tuple[int, List[str]]]]
+    for o in range(1, 5):
+        options = []
+        if open_costs[o]:
+            options.append((open_costs[o], ["open"]))
+        if breach["focus"] and best[o-1] is not None:
+            cost, actions = best[o-1]
+            options.append((breach["focus"] + cost, ["focus"] + actions))
+        best.append(min(options, key=lambda x: (x[0], -len(x[1])), default=None))
+
+    plans = []
+    for start in range(5):
+        row = []
+        for target in range(5):
+            if target == start:
+                row.append((0, []))
+            elif target == 0:
+                row.append(best[start])
+            elif target < start and breach["focus"]: # can only get there by focusing
+                row.append((breach["focus"] * (start - target), ["focus"] * (start - target)))
+            else:
+                row.append(None)
+        plans.append(row)
+    return plans
+
 def load_breaches(relpath=None):
     file = "breaches.csv"
     if relpath is None:
@@ -304,11 +508,13 @@ def load_breaches(relpath=None):
         for name, pos, focus, left, down, right, effect, mage in content:
             if not name or name.startswith("#"):
                 continue
-            breach_values[casefold(name)].append({
+            breach = {
                 "name": name, "position": int(pos), "focus": int(focus),
                 "left": int(left), "down": int(down), "right": int(right),
                 "effect": expand(effect), "mage": mage, "guild": int(relpath) if relpath else 0
-            })
+            }
+            breach["plans"] = breach_plans(breach)
+            breach_values[casefold(name)].append(breach)
 
     log("Breaches loaded", level="local")
 
@@ -342,9 +548,246 @@ def load_treasures(relpath=None):
 
     log("Treasures loaded", level="local")
 
+def _isin(code, *items: str) -> bool:
+    """Temporary hack until the parser is functional."""
+    for item in items:
+        if f"{item}=" in code:
+            return True
+    return False
+
+def normalise_id(x: str) -> str:
+    return "".join(c for c in x.upper() if c.isalnum())
+
+def printed_id(prefix: Optional[str], deck: Optional[str], num: int) -> str:
+    if prefix and deck:
+        return f"{prefix}-{deck}-{num}"
+    return f"{prefix or deck}{num}"
+
+def _heads_re(heads) -> re.Pattern:
+    # longest first, so that "VIII25" is not read as deck "VII" and card "I25"
+    heads = sorted(heads, key=len, reverse=True)
+    return re.compile(f"({'|'.join(re.escape(x) for x in heads)})(\\d+)")
+
+def load_card_ids():
+    card_ids.clear()
+    deck_ids.clear()
+    _wave_grammars.clear()
+    global _card_id_re
+
+    for prefix, decks in cards_num.items():
+        names = {normalise_id(deck or ""): deck for deck in decks}
+        _wave_grammars[prefix] = (_heads_re(names), names)
+        for deck, cards in decks.items():
+            head = normalise_id((prefix or "") + (deck or ""))
+            for num, (ctype, name) in cards.items():
+                value = (printed_id(prefix, deck, num), ctype, name)
+                card_ids.setdefault(head, {}).setdefault(num, []).append(value)
+                if prefix and deck:
+                    deck_ids.setdefault(normalise_id(deck), {}).setdefault(num, []).append(value)
+
+    _card_id_re = _heads_re(set(card_ids) | set(deck_ids))
+    log("Card IDs compiled", level="local")
+
+def split_card_id(x: str) -> Optional[Tuple[str, int]]:
+    """Split a printed card ID into its normalised head and its number."""
+    match = _card_id_re.fullmatch(normalise_id(x))
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+def find_card_ids(head: str, num: int) -> List[Tuple[str, str, str]]:
+    """Return every card printed with that ID; full IDs win over prefix-less ones."""
+    return card_ids.get(head, {}).get(num) or deck_ids.get(head, {}).get(num) or []
+
+def resolve_card_id(x: str, wave: Optional[str]) -> Tuple[str, str]:
+    """Resolve a card ID as written on the mats, relative to their wave, into (card type, name)."""
+    if x.count("-") == 2: # from another wave, like GH-1b-05
+        prefix, x = x.split("-", 1)
+        wave = next((p for p in cards_num if p and normalise_id(p) == normalise_id(prefix)), prefix)
+    grammar, names = _wave_grammars[wave]
+    match = grammar.fullmatch(normalise_id(x))
+    if match is None:
+        raise ValueError(f"Unrecognized card {x}")
+    return cards_num[wave][names[match.group(1)]][int(match.group(2))]
+
+def load_references():
+    nemesis_users.clear()
+    starter_users.clear()
+    mage_breaches.clear()
+    content = {"N": nemesis_cards, "P": player_cards, "T": treasure_values, "O": treasure_values}
+
+    for mats in nemesis_mats.values():
+        for mat in mats:
+            wave = waves[mat["box"]][0]
+            refs = []
+            for x in mat["cards"]:
+                try:
+                    ctype, card = resolve_card_id(x, wave)
+                except (ValueError, KeyError):
+                    log(f"Unknown card {x} for {mat['name']}", level="error")
+                    refs.append(("?", f"ERROR: Unrecognized card {x}", None))
+                    continue
+                records = content[ctype].get(casefold(card))
+                refs.append((ctype, card, records[0] if records else None))
+                if mat not in nemesis_users[casefold(card)]:
+                    nemesis_users[casefold(card)].append(mat)
+            mat["card_refs"] = refs
+
+    for mats in player_mats.values():
+        for mat in mats:
+            try:
+                mat["starting"] = starting_cards(mat)
+            except KeyError:
+                log(f"Could not resolve the starting cards of {mat['name']}", level="error")
+                mat["starting"] = None
+                continue
+            for card in set(mat["starting"][0] + mat["starting"][1]):
+                starter_users[casefold(card)].append(mat)
+
+    for breaches in breach_values.values():
+        for breach in breaches:
+            breach["mage_mat"] = None
+            if not breach["mage"]:
+                continue
+            mage = casefold(breach["mage"])
+            mats = player_mats.get(mage)
+            if not mats: # names like "Sahala" for "Sahala (NA)"
+                keys = [x for x in player_mats if x.startswith(mage)]
+                if len(keys) == 1:
+                    mats = player_mats[keys[0]]
+            if mats:
+                breach["mage_mat"] = mats[0]
+                mage_breaches[casefold(mats[0]["name"])].append(breach)
+
+    log("References resolved", level="local")
+
+def _paginate(title: str, lines: List[str]) -> List[str]:
+    pages = []
+    page = [title, ""]
+    count = len(title)
+    header = None
+    for i, line in enumerate(lines):
+        if line.startswith("Deck: "):
+            header = line
+        if count + len(line) >= 1800 or (not line and count + len(lines[i+1]) + len(lines[i+2]) >= 1800):
+            pages.append(page) # a deck header is never left at the bottom of a page
+            page = [title, ""]
+            count = len(title)
+            if line.startswith("- ") and header:
+                page.append(f"{header} (continued)")
+                count += len(page[-1]) + 1
+        if not line and len(page) == 2: # no blank line right under the title
+            continue
+        page.append(line)
+        count += len(line) + 1
+    pages.append(page)
+    return ["```\n" + "\n".join(page) + "\n```" for page in pages]
+
+def load_box_pages():
+    box_pages.clear()
+    content = {"P": player_cards, "N": nemesis_cards, "T": treasure_values, "O": treasure_values}
+
+    for box, (prefix, wave) in waves.items():
+        listings = {} # type: Dict[Optional[str], List[str]]
+        decks = {} # type: Dict[Optional[str], Optional[str]]
+        for deck, cards in cards_num.get(prefix, {}).items():
+            for num, (ctype, name) in cards.items():
+                for record in content[ctype].get(casefold(name), ()):
+                    if record["box"] != box:
+                        continue
+                    for key in (None, record["type"]):
+                        lines = listings.setdefault(key, [])
+                        # promo cards do their own thing
+                        if deck and deck != "Promo" and decks.get(key) != deck:
+                            lines.extend(["", f"Deck: {deck}"])
+                        decks[key] = deck
+                        lines.append(f"- {name} ({ctypes.get(record['type'], record['type'])}) ({num})")
+
+        box_pages[box] = {}
+        for key, lines in listings.items():
+            title = f"Cards from {box}:" if key is None else f"{ctypes.get(key, key)} cards from {box}:"
+            box_pages[box][key] = _paginate(title, lines)
+
+    log("Box listings built", level="local")
+
+def load_autocomplete():
+    autocomplete_index.clear()
+    entries = defaultdict(lambda: defaultdict(set))
+    for kind, mapping in (("card", player_cards), ("card", nemesis_cards), ("card", treasure_values),
+                          ("mat", player_mats), ("mat", nemesis_mats)):
+        for key, values in mapping.items():
+            for value in values:
+                entries[value["guild"]][kind].add((key, value["name"]))
+    for name in mechanics:
+        entries[0]["mechanic"].add((casefold(name), name))
+    for box in waves:
+        entries[0]["box"].add((casefold(box), box))
+
+    for guild, kinds in entries.items():
+        autocomplete_index[guild] = {kind: sorted(values) for kind, values in kinds.items()}
+
+    log("Autocomplete index built", level="local")
+
+def complete_names(guild: int, prefix: str, kinds: Iterable[str], limit: int = 25) -> List[Tuple[str, str]]:
+    """Return up to limit (casefolded name, name) starting with prefix, in order."""
+    prefix = casefold(prefix)
+    results = []
+    for index in (autocomplete_index.get(0, {}), autocomplete_index.get(guild, {}) if guild else {}):
+        for kind in kinds:
+            values = index.get(kind, ())
+            i = bisect_left(values, (prefix,))
+            end = min(i + limit, len(values))
+            while i < end and values[i][0].startswith(prefix):
+                results.append(values[i])
+                i += 1
+    results = sorted(set(results))
+    return results[:limit]
+
+def load_indices():
+    market_index.clear()
+    nemesis_index.clear()
+    mage_index.clear()
+    basic_index.clear()
+    expedition_index.clear()
+    randomizer_cache.clear()
+
+    for cards in player_cards.values():
+        for card in cards:
+            if card["type"] not in _market_types or card["starter"]:
+                continue
+            if _isin(card["code"], "T", "U", "N"):
+                continue
+            costs = market_index.setdefault(card["box"], {}).setdefault(card["type"], {})
+            costs.setdefault(card["cost"], []).append(card)
+
+    for cards in nemesis_cards.values():
+        for card in cards:
+            if card["category"] not in _basic_categories:
+                continue
+            tiers = basic_index.setdefault(card["box"], {})
+            tiers.setdefault(card["tier"], {}).setdefault(card["category"], []).append(card)
+
+    for mats in nemesis_mats.values():
+        for mat in mats:
+            if "NOEXP" in mat["code"]:
+                continue
+            nemesis_index.setdefault(mat["box"], {}).setdefault(mat["difficulty"], []).append(mat)
+            if mat["battle"].isdigit():
+                expedition_index.setdefault(int(mat["battle"]), []).append(mat)
+
+    for mats in expedition_index.values():
+        mats.sort(key=lambda x: (x["difficulty"], x["name"]))
+
+    for mats in player_mats.values():
+        for mat in mats:
+            mage_index.setdefault(mat["box"], {}).setdefault(mat["rating"], []).append(mat)
+
+    log("Randomizer indices built", level="local")
+
 def load():
+    global generation
+    generation += 1
     load_meta()
-    load_unique()
     load_pcards()
     load_ncards()
     load_pmats()
@@ -361,3 +804,55 @@ def load():
             load_nmats(folder)
             load_breaches(folder)
             load_treasures(folder)
+
+    load_card_ids()
+    load_unique()
+    load_box_pages()
+    load_autocomplete()
+    load_indices()
+    load_references()
+
+def _sources_fingerprint() -> str:
+    """Hash of the names, sizes and modification times of everything load() reads."""
+    digest = hashlib.sha1()
+    paths = [x for x in os.listdir(".") if x.endswith(".csv")]
+    for folder in ("unique", "assets", "guilds"):
+        for root, dirs, files in os.walk(folder):
+            paths.extend(os.path.join(root, x) for x in files)
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def save_catalog(path: str) -> None:
+    """Save the loaded content, so that other processes can skip parsing the csv files."""
+    catalog = {
+        "version": _catalog_version,
+        "sources": _sources_fingerprint(),
+        "card_id_re": _card_id_re,
+        "content": {name: globals()[name] for name in _catalog_names},
+    }
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(catalog, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    log(f"Catalog saved to {path}", level="local")
+
+def load_catalog(path: str) -> bool:
+    """Load the content from a catalog made by save_catalog; False if it is missing or out of date."""
+    global generation, _card_id_re
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        catalog = pickle.load(f)
+    if catalog.get("version") != _catalog_version or catalog.get("sources") != _sources_fingerprint():
+        log(f"Catalog {path} is out of date", level="local")
+        return False
+
+    generation += 1
+    for name, value in catalog["content"].items():
+        globals()[name].clear()
+        globals()[name].update(value)
+    _card_id_re = catalog["card_id_re"]
+    randomizer_cache.clear()
+    log(f"Catalog loaded from {path}", level="local")
+    return True
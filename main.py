@@ -1,16 +1,25 @@
-from typing import List
+from typing import Dict, List, Optional, Tuple
+import os
 
 import discord
-import os
 from discord.ext import commands
 
 import config
 from code_parser import format
-from cmds import cmds, get_card, complete_match, card_, content_dicts, command
+from cmds import cmds, get_card, parse_query, build_router, content_dicts, command, find_mage, _base_cmds, _owner_cmds
+from asset_cache import send_asset
+from executor import run_cpu
+from outbound import QueuedContext
+from singleflight import coalesce
+import analysis # registers !analyze
+import simulate # registers !simulate
+import slash
+import loader
 from loader import (
     log,
     casefold,
     load,
+    load_catalog,
     mechanics,
     player_cards,
     player_mats,
@@ -18,7 +27,6 @@ from loader import (
     waves,
     nemesis_mats,
     nemesis_cards,
-    cards_num,
     ability_types,
     breach_values,
     treasure_values,
@@ -47,7 +55,10 @@ breaches_orientation = (
 # (position*number of focuses)-number of focuses+1
 
 log("Loading content", level="local")
-load()
+# shards.py builds the catalog once and hands it to every shard process
+_catalog = os.environ.get("LEXIVE_CATALOG")
+if not (_catalog and load_catalog(_catalog)):
+    load()
 log("Loading complete", level="local")
 
 activity = discord.Activity(
@@ -58,7 +69,48 @@ activity = discord.Activity(
     state="Studying the arcane knowledge",
 )
 
+# prefix or part of a command name -> the one command it means, and the ones
+# only used when the lookup finds nothing; built on the first request and again
+# after a reload, since they depend on the content names
+_routes = (0, {}, {}) # type: Tuple[int, Dict[str, str], Dict[str, str]]
+
+async def dispatch(ctx, content: str) -> None:
+    """Answer one request: a command, else one of the bot.command ones, else a content lookup."""
+    global _routes
+    if _routes[0] != loader.generation: # every command is registered by now
+        names = set()
+        for func, mapping in content_dicts:
+            names.update(mapping)
+        _routes = (loader.generation, *build_router(cmds, _base_cmds, _owner_cmds, names))
+    value = content.split()
+    if not value:
+        return
+    name = _routes[1].get(value[0])
+    if name is not None:
+        await cmds[name](ctx, *value[1:])
+        return
+    if getattr(ctx, "command", None) is not None: # like report
+        await ctx.bot.invoke(ctx)
+        return
+
+    guild = ctx.guild.id if ctx.guild is not None else 0
+    query = parse_query(content)
+    values, asset = await coalesce(("card", guild, query), run_cpu, get_card, ctx.guild, content, query)
+    if values and values[0] is None: # too many values
+        await ctx.send(f"Ambiguous value. Possible matches: {', '.join(values[1:])}")
+    elif values:
+        msgs = "\n".join(values).split(r"\NEWLINE/")
+        for msg in msgs:
+            await ctx.send(msg)
+        for ass in asset:
+            await send_asset(ctx, ass)
+    elif value[0] in _routes[2]:
+        await cmds[_routes[2][value[0]]](ctx, *value[1:])
+
 class Lexive(commands.Bot):
+    async def on_ready(self):
+        log(memory_report(self), level="local")
+
     async def on_message(self, message: discord.Message):
         if message.author == self.user:
             return
@@ -67,35 +119,38 @@ class Lexive(commands.Bot):
             if not content:
                 return
 
-            ctx = await self.get_context(message)
+            ctx = await self.get_context(message, cls=QueuedContext)
             try:
                 log("REQ:", content)
-                value = content.split()
-                matches = complete_match(value[0], cmds)
-                if len(matches) == 1:
-                    await cmds[matches[0]](ctx, *value[1:])
-                    return
-
-                values, asset = get_card(ctx.guild, content)
-                if values and values[0] is None: # too many values
-                    await ctx.send(f"Ambiguous value. Possible matches: {', '.join(values[1:])}")
-                    return
-                elif values:
-                    msgs = "\n".join(values).split(r"\NEWLINE/")
-                    for msg in msgs:
-                        await ctx.send(msg)
-                    for ass in asset:
-                        with open(os.path.join("assets", ass), mode="rb") as a:
-                            await ctx.send(file=discord.File(a))
-                    return
+                await dispatch(ctx, content)
+                # failed sends are reported like failed commands
+                await ctx.sent()
             except Exception as e:
                 if hasattr(config, "server") and hasattr(config, "channel"):
                     await report(ctx, f"[Automatic reporting]\n{e}")
                 raise
 
-            await super().on_message(message)
-
-bot = Lexive(command_prefix=config.prefix, owner_id=config.owner, case_insensitive=True, activity=activity, intents=discord.Intents.all())
+class ShardedLexive(Lexive, commands.AutoShardedBot):
+    pass
+
+_bot_options = dict(command_prefix=config.prefix, owner_id=config.owner, case_insensitive=True, activity=activity, intents=discord.Intents.all())
+if getattr(config, "gateway_profile", "full") == "low_memory":
+    # only what on_message needs: no members, presences or message cache
+    _intents = discord.Intents.none()
+    _intents.guilds = True
+    _intents.guild_messages = True
+    _intents.dm_messages = True
+    _intents.message_content = True
+    _bot_options.update(intents=_intents, member_cache_flags=discord.MemberCacheFlags.none(),
+                        chunk_guilds_at_startup=False, max_messages=None)
+# "<shard ids>:<shard count>", set by shards.py for each shard process
+_shards = os.environ.get("LEXIVE_SHARDS")
+if _shards:
+    _ids, _count = _shards.split(":")
+    bot = ShardedLexive(shard_ids=[int(x) for x in _ids.split(",")], shard_count=int(_count), **_bot_options)
+else:
+    bot = Lexive(**_bot_options)
+slash.setup(bot)
 
 @bot.command("report") # not a regular @command because we don't want autocomplete for this one
 async def report_cmd(ctx, *args):
@@ -111,10 +166,46 @@ async def report(ctx, message):
             chan = guild.get_channel(config.channel)
             await chan.send(message)
 
+_author_user = None # type: Optional[discord.User]
+
+async def _get_author(bot) -> Optional[discord.User]:
+    # without the members intent the author is usually not cached, so fetch them once
+    global _author_user
+    if _author_user is None:
+        _author_user = bot.get_user(author_id)
+    if _author_user is None:
+        try:
+            _author_user = await bot.fetch_user(author_id)
+        except discord.HTTPException:
+            return None
+    return _author_user
+
+def _resident_memory() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError): # not on Linux
+        return None
+
+def memory_report(bot) -> str:
+    rss = _resident_memory()
+    guilds = len(bot.guilds)
+    members = sum(len(x.members) for x in bot.guilds)
+    values = [f"Gateway profile: {getattr(config, 'gateway_profile', 'full')}", f"Guilds: {guilds}",
+              f"Cached: {len(bot.users)} users, {members} members, {len(bot.cached_messages)} messages"]
+    if rss is not None:
+        values.append(f"Resident memory: {rss / 2**20:.1f} MiB" + (f", {rss / guilds / 2**10:.1f} KiB per guild" if guilds else ""))
+    return "\n".join(values)
+
+@command()
+async def memstats(ctx, *args):
+    if await ctx.bot.is_owner(ctx.author):
+        await ctx.send(f"```\n{memory_report(ctx.bot)}\n```")
+
 @command()
 async def whoami(ctx, *args):
     author = AUTHOR
-    aid = ctx.bot.get_user(author_id)
+    aid = await _get_author(ctx.bot)
     mention = ""
     if aid is not None:
         author += f" ({aid.mention})"
@@ -136,58 +227,8 @@ async def whoami(ctx, *args):
 @sync(mechanics)
 def unique_handler(guild, name: str) -> List[str]:
     # there is no support for guild-specific mechanic currently
-    mechanic = mechanics[name][0]["content"]
-    values = []
-    if len(mechanic) == 1: # most common occurence
-        values.append("```")
-        values.append(mechanic[0].rstrip("\n").format(prefix=config.prefix))
-        values.append("```")
-
-    else: # manually go through
-        class _card_internal:
-            def __getitem__(self, item):
-                return card_(item)
-        def preformat(x: str) -> str:
-            return x.format(prefix=config.prefix, newline="", card=_card_internal())
-
-        is_title = False
-        is_continue = False
-        continuing = False
-        for current in mechanic:
-            current = current.rstrip("\n")
-            if not current:
-                if continuing:
-                    values.append("```")
-                    continuing = False
-                continue
-            if current == "TITLE":
-                is_title = True
-                continue
-            if current == "CONTINUE":
-                is_continue = True
-                continue
-            if current == "NEXT":
-                values.append(r"\NEWLINE/")
-                continue
-            if is_title:
-                values.append(preformat(current))
-                is_title = False
-                continue
-            if continuing:
-                values.append(preformat(current))
-                continue
-
-            if values and not is_continue:
-                values.append(r"\NEWLINE/")
-            values.append("```")
-            values.append(preformat(current))
-            continuing = True
-            is_continue = False
-
-        if continuing:
-            values.append("```")
-
-    return values
+    # the files are compiled when loading, see loader.load_unique
+    return list(mechanics[name][0]["content"])
 
 @sync(player_cards)
 def player_card(guild, name: str) -> List[str]:
@@ -327,7 +368,6 @@ def nemesis_card(guild, name: str) -> List[str]:
 
 @sync(player_mats)
 def player_mat(guild, name: str) -> List[str]:
-    x: str
     mat = player_mats[name]
     values = []
     for c in mat:
@@ -349,27 +389,10 @@ def player_mat(guild, name: str) -> List[str]:
             values.append(f"{config.prefix}{special} - {breaches_orientation[pos]}")
 
         values.append("")
-        wave = waves[c['box']][0]
-        hand = []
-        deck = []
-        for orig, new in zip((c["hand"], c["deck"]), (hand, deck)):
-            for x in orig:
-                if x.count("-") == 2:
-                    wave, x = x.split("-", 1)
-                    x = x.replace("-", "")
-                if x.isdigit():
-                    x = cards_num[wave][None][int(x)][1]
-                elif x[0].isdigit() and x[1].isalpha() and x[2:].isdigit():
-                    x = cards_num[wave][x[:2]][int(x[2:])][1]
-                elif x[:3] == "END" and x[3:].isdigit():
-                    x = cards_num[wave]["END"][int(x[3:])][1]
-                elif x == "C":
-                    x = "Crystal"
-                elif x == "S":
-                    x = "Spark"
-                else:
-                    x = f"ERROR: Unrecognized card {x}"
-                new.append(x)
+        if c['starting'] is None:
+            hand, deck = ["ERROR: Could not resolve starting hand"], ["ERROR: Could not resolve starting deck"]
+        else:
+            hand, deck = c['starting']
         hand_readable = []
         deck_readable = []
         for orig, new in zip((hand, deck), (hand_readable, deck_readable)):
@@ -441,54 +464,17 @@ def nemesis_mat(guild, name: str) -> List[str]:
         values.append("")
 
         largest = 0
-        box = cards_num[waves[c['box']][0]]
-
         cards = []
-        for x in c["cards"]:
-            if x.isdigit() and x[0] in box:
-                deck = x[0]
-                num = int(x[1:])
-            elif x.isdigit(): # Cards that have nothing but a number.
-                deck = None
-                num = int(x)
-            elif x[0].isdigit() and x[1].isalpha() and x[2:].isdigit(): # regular non-Legacy stuff, like "2a19", i.e. x[0] is "2", x[1] is "a" and the rest is "19"
-                deck = x[:2]
-                num = int(x[2:])
-            # Legacy of Gravehold specific cases are handled below because LoG is the first wave where the deck name doesn't necessarily
-            # start with a digit like 1c or 2a, so the above case handles some, but not most of those decks.
-            elif x[0].isalpha():
-                if x[1].isalpha():
-                    if x[2].isalpha():
-                        # 3 alphas means END deck
-                        deck = x[:3]
-                        num = int(x[3:])
-                    elif x[2].isdigit():
-                        # 2 alphas means most regular decks, e.g. BS
-                        deck = x[:2]
-                        num = int(x[2:])
-                elif x[1].isdigit():
-                    # 1 alpha means E, i.e. the event deck.
-                    deck = x[0]
-                    num = int(x[1:])
-            else: # Legacy stuff
-                for d in ("Ic", "II", "III", "IV", "V", "VI", "VII", "VIII", "END"):
-                    if x.startswith(d) and x[len(d):].isdigit():
-                        deck = d
-                        num = int(x[len(d):])
-                        break
-                else:
-                    raise ValueError(f"Unknown card {x} for {name}")
-
-            ctype, card = box[deck][num]
-
+        for ctype, card, content in c["card_refs"]:
             if ctype == "N":
-                content = nemesis_cards[casefold(card)][0]
                 cards.append((f"(Tier {content['tier']} {{0}}) {card}",
                 ctypes[content['type']]))
             elif ctype == "P":
-                content = player_cards[casefold(card)][0]
                 cards.append((f"({content['cost']}-Cost {{0}}) {card}",
                 ctypes[content['type']]))
+            else: # unresolved or unsupported
+                cards.append((card, ""))
+                continue
             largest = max(largest, len(ctypes[content["type"]]))
 
         cards = [text.format(t.ljust(largest)) for text, t in cards]
@@ -534,12 +520,84 @@ def get_breach(guild, name: str) -> List[str]:
         if c['mage']:
             values.append("") # if we have a mage, there is an effect
             # [0] is "wrong", but technically mages should never overlap because if they do they have suffixes
-            values.append(f"Used with {c['mage']} (From {player_mats[casefold(c['mage'])][0]['box']})")
+            if c['mage_mat'] is not None:
+                values.append(f"Used with {c['mage']} (From {c['mage_mat']['box']})")
+            else:
+                values.append(f"Used with {c['mage']}")
 
         values.append("```")
 
     return values
 
+def _mage_breach(mat: dict, i: int, special: Optional[str]) -> Optional[dict]:
+    """Find which breach is in the mage's i-th breach spot."""
+    name = casefold(special if special is not None else f"Breach {('I', 'II', 'III', 'IV')[i]}")
+    candidates = breach_values.get(name)
+    if not candidates: # some have a reminder after the name, like "Defender Breach (On Cast: ...)"
+        for key, values in breach_values.items():
+            if name.startswith(key):
+                candidates = values
+                break
+        else:
+            return None
+    for b in candidates:
+        if b['mage'] == mat['name']:
+            return b
+    return candidates[0]
+
+@command()
+async def openplan(ctx, *args):
+    open_all = True
+    targets = set()
+    names = list(args)
+    # trailing roman numerals or digits are which breaches to open
+    while len(names) > 1 and names[-1].upper() in ("I", "II", "III", "IV", "1", "2", "3", "4"):
+        value = names.pop().upper()
+        targets.add(int(value) - 1 if value.isdigit() else ("I", "II", "III", "IV").index(value))
+        open_all = False
+    if not names:
+        await ctx.send(f"Usage: `{config.prefix}openplan <mage> [breaches to open, e.g. II III]`")
+        return
+    mat, error = find_mage(ctx.guild, " ".join(names))
+    if mat is None:
+        await ctx.send(error)
+        return
+
+    values = ["```", f"Cheapest way to open the breaches of {mat['name']}:", ""]
+    total = focuses = 0
+    for i, (pos, special) in enumerate(mat['breaches']):
+        breach = _mage_breach(mat, i, special)
+        label = breach['name'] if breach is not None and special is not None else f"Breach {('I', 'II', 'III', 'IV')[i]}"
+        if pos == 9 or breach is None: # no breach
+            continue
+        if not open_all and i not in targets:
+            continue
+        plan = breach['plans'][pos][0]
+        if plan is None:
+            values.append(f"{label} ({breaches_orientation[pos].lower()}): cannot be opened")
+            continue
+        cost, actions = plan
+        if not actions:
+            values.append(f"{label}: already open")
+            continue
+        steps = []
+        orientation = pos
+        for action in actions:
+            if action == "focus":
+                steps.append(f"focus ({breach['focus']}$)")
+                orientation -= 1
+            else:
+                opening = (0, breach['focus'], breach['left'], breach['down'], breach['right'])[orientation]
+                steps.append(f"open ({opening}$)")
+        values.append(f"{label} ({breaches_orientation[pos].lower()}): {', '.join(steps)} = {cost}$")
+        total += cost
+        focuses += actions.count("focus")
+
+    values.append("")
+    values.append(f"Total: {total}$, gaining {focuses} charge(s) from focusing")
+    values.append("```")
+    await ctx.send("\n".join(values))
+
 @sync(treasure_values)
 def get_treasure(guild, name: str) -> List[str]:
     t = treasure_values[name]
@@ -0,0 +1,81 @@
+from typing import Dict, Optional
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+
+try:
+    from PIL import Image
+except ImportError: # optional, only needed to build the variants
+    Image = None
+
+# Optional build step for the art in assets/: writes a resized, recompressed
+# (or WebP) variant of each file to the variants folder, named after the hash
+# of the source so that unchanged files are not converted again. The manifest
+# tells asset_cache which variant to send instead of the original; a variant
+# that ends up larger than its source is not used.
+# Run with `python optimise_assets.py [--max-size N] [--quality N] [--webp]`.
+
+variants_dir = "assets_optimised"
+manifest_file = os.path.join(variants_dir, "manifest.json")
+
+def load_manifest() -> Dict[str, dict]:
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, "rt") as f:
+        return json.load(f)
+
+def _convert(data: bytes, max_size: int, quality: int, webp: bool) -> bytes:
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    if image.mode not in ("RGB", "RGBA") or (image.mode == "RGBA" and not webp):
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    if webp:
+        image.save(out, "WEBP", quality=quality, method=6)
+    else:
+        image.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+def build(max_size: int, quality: int, webp: bool) -> Dict[str, dict]:
+    os.makedirs(variants_dir, exist_ok=True)
+    manifest = {}
+    ext = "webp" if webp else "jpg"
+    for filename in sorted(os.listdir("assets")):
+        path = os.path.join("assets", filename)
+        with open(path, mode="rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        stat = os.stat(path)
+        variant = f"{digest[:16]}-{max_size}-{quality}.{ext}" # type: Optional[str]
+        target = os.path.join(variants_dir, variant)
+        if not os.path.isfile(target):
+            converted = _convert(data, max_size, quality, webp)
+            with open(target, mode="wb") as f:
+                f.write(converted)
+            print(f"{filename}: {len(data)} -> {len(converted)} bytes")
+        if os.path.getsize(target) >= len(data):
+            variant = None
+        manifest[filename] = {"sha256": digest, "mtime": stat.st_mtime_ns, "size": stat.st_size, "variant": variant}
+
+    used = {x["variant"] for x in manifest.values()}
+    for filename in os.listdir(variants_dir): # stale variants
+        if filename != os.path.basename(manifest_file) and filename not in used:
+            os.remove(os.path.join(variants_dir, filename))
+
+    with open(manifest_file, "wt") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+if __name__ == "__main__":
+    if Image is None:
+        sys.exit("Pillow is required to optimise the assets")
+    parser = argparse.ArgumentParser(description="Build optimised variants of the assets")
+    parser.add_argument("--max-size", type=int, default=800, help="Largest width or height, in pixels")
+    parser.add_argument("--quality", type=int, default=85, help="Encoder quality (1-100)")
+    parser.add_argument("--webp", action="store_true", help="Make WebP variants instead of JPEG")
+    args = parser.parse_args()
+    manifest = build(args.max_size, args.quality, args.webp)
+    print(f"{sum(1 for x in manifest.values() if x['variant'])} of {len(manifest)} assets have a smaller variant")
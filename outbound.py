@@ -0,0 +1,183 @@
+from collections import deque
+from typing import Deque, Dict, Optional
+import asyncio
+import itertools
+import time
+
+from discord.ext.commands.context import Context
+
+from loader import log
+
+import config
+
+# Outbound messages go through one queue per channel. Plain text messages are
+# queued and sent in the background, in order, and adjacent ones are merged
+# into a single message when they fit; anything with a file or an embed waits
+# for its own message to be sent and returns it. A QueuedContext keeps the
+# futures of its text messages so the command can wait for them afterwards and
+# see the error if one could not be sent. Every send first waits for
+# a slot in the channel's bucket and in the global one, so the bot stays
+# under Discord's rate limits instead of running into 429s.
+
+# at most this many messages per channel every so many seconds
+_channel_rate = getattr(config, "channel_rate", (5, 5.0))
+# and this many overall
+_global_rate = getattr(config, "global_rate", (50, 1.0))
+
+_max_length = 2000
+
+class _Bucket:
+    """At most rate requests in any window of per seconds."""
+
+    def __init__(self, rate: int, per: float, clock=time.monotonic):
+        self.per = per
+        self.clock = clock
+        self.sent = deque(maxlen=rate) # type: Deque[float]
+
+    def take(self) -> float:
+        """Take a slot if there is one and return 0, else return how long until there is."""
+        now = self.clock()
+        if len(self.sent) == self.sent.maxlen and now - self.sent[0] < self.per:
+            return self.sent[0] + self.per - now
+        self.sent.append(now)
+        return 0.0
+
+    async def acquire(self, sleep=asyncio.sleep) -> None:
+        delay = self.take()
+        while delay:
+            await sleep(delay)
+            delay = self.take()
+
+class _Item:
+    def __init__(self, sender, content: Optional[str], kwargs: dict, future: asyncio.Future, queued: float):
+        self.sender = sender
+        self.content = content
+        self.kwargs = kwargs
+        self.future = future
+        self.queued = queued
+
+class SendQueue:
+    def __init__(self, channel_rate=_channel_rate, global_rate=_global_rate, clock=time.monotonic, sleep=asyncio.sleep):
+        self.channel_rate = channel_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.bucket = _Bucket(*global_rate, clock=clock)
+        self.buckets = {} # type: Dict[int, _Bucket]
+        self.pending = {} # type: Dict[int, Deque[_Item]]
+        self.workers = {} # type: Dict[int, asyncio.Task]
+        self.stats = {"queued": 0, "sent": 0, "merged": 0, "depth": 0, "max_depth": 0, "latency": 0.0, "max_latency": 0.0}
+
+    async def send(self, channel: int, sender, content: Optional[str] = None, **kwargs):
+        """Queue a message for sender(content, **kwargs). Anything with kwargs is waited for and
+        its message returned; text is sent in the background and the future for it returned,
+        which gets the message or the error it was sent with."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(channel, deque()).append(_Item(sender, None if content is None else str(content), kwargs, future, self.clock()))
+        self.stats["queued"] += 1
+        self.stats["depth"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.stats["depth"])
+        if channel not in self.workers:
+            worker = self.workers[channel] = asyncio.ensure_future(self._run(channel))
+            worker.add_done_callback(lambda task: self._done(channel, task))
+        if kwargs:
+            return await future
+        future.add_done_callback(lambda f: self._check(channel, f))
+        return future
+
+    def _check(self, channel: int, future: asyncio.Future) -> None:
+        # also marks the error as retrieved for callers that never wait for it
+        if not future.cancelled() and future.exception() is not None:
+            log(f"Could not send a message to {channel}: {future.exception()}", level="error")
+
+    async def join(self, channel: Optional[int] = None) -> None:
+        """Wait until everything queued (for that channel) was sent."""
+        for key, task in list(self.workers.items()):
+            if channel is None or key == channel:
+                await asyncio.shield(task)
+
+    def _merge(self, items: Deque[_Item]) -> list:
+        # they stay queued until sent, so that _stop() sees them
+        batch = [items[0]]
+        if batch[0].kwargs or batch[0].content is None:
+            return batch
+        length = len(batch[0].content)
+        for item in itertools.islice(items, 1, None):
+            if item.kwargs or item.content is None:
+                break
+            length += len(item.content) + 1
+            if length > _max_length:
+                break
+            batch.append(item)
+        return batch
+
+    async def _run(self, channel: int) -> None:
+        items = self.pending[channel]
+        bucket = self.buckets.setdefault(channel, _Bucket(*self.channel_rate, clock=self.clock))
+        try:
+            while items:
+                batch = self._merge(items)
+                await bucket.acquire(self.sleep)
+                await self.bucket.acquire(self.sleep)
+                first = batch[0]
+                content = first.content if len(batch) == 1 else "\n".join(x.content for x in batch)
+                try:
+                    message = await first.sender(content, **first.kwargs)
+                except Exception as e:
+                    for x in batch:
+                        if not x.future.done(): # a caller waiting for a file may have been cancelled
+                            x.future.set_exception(e)
+                else:
+                    for x in batch:
+                        if not x.future.done():
+                            x.future.set_result(message)
+                for x in batch:
+                    items.popleft()
+
+                now = self.clock()
+                self.stats["sent"] += 1
+                self.stats["merged"] += len(batch) - 1
+                self.stats["depth"] -= len(batch)
+                for x in batch:
+                    self.stats["latency"] += now - x.queued
+                    self.stats["max_latency"] = max(self.stats["max_latency"], now - x.queued)
+        finally:
+            self._stop(channel, asyncio.current_task())
+
+    def _done(self, channel: int, task: asyncio.Task) -> None:
+        # a worker cancelled before it started never reaches its finally
+        if not task.cancelled() and task.exception() is not None:
+            log(f"The send queue for {channel} stopped: {task.exception()}", level="error")
+        self._stop(channel, task)
+
+    def _stop(self, channel: int, task: asyncio.Task) -> None:
+        """Forget the worker, and fail whatever it left unsent so that nobody waits for it forever."""
+        if self.workers.get(channel) is not task:
+            return
+        del self.workers[channel]
+        left = [x for x in self.pending.pop(channel) if not x.future.done()]
+        self.stats["depth"] -= len(left)
+        for x in left:
+            x.future.set_exception(RuntimeError(f"The send queue for {channel} stopped before this message was sent"))
+
+    def report(self) -> str:
+        queued = self.stats["queued"] or 1
+        return (f"Send queue: {self.stats['depth']} waiting (at most {self.stats['max_depth']}), {self.stats['queued']} queued, " +
+                f"{self.stats['sent']} sent, {self.stats['merged']} merged, latency {self.stats['latency'] / queued * 1000:.1f}ms " +
+                f"average, {self.stats['max_latency'] * 1000:.1f}ms max")
+
+queue = SendQueue()
+
+class QueuedContext(Context):
+    """Context whose send() goes through the per-channel queue."""
+
+    async def send(self, content=None, **kwargs):
+        result = await queue.send(self.channel.id, super().send, content, **kwargs)
+        if not kwargs:
+            self.__dict__.setdefault("_sending", []).append(result)
+        return result
+
+    async def sent(self) -> None:
+        """Wait for the text messages sent so far; raises what the first failed one raised."""
+        sending, self._sending = getattr(self, "_sending", []), []
+        for future in sending:
+            await future
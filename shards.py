@@ -0,0 +1,154 @@
+from typing import List, Optional
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+from loader import load, log, save_catalog
+
+import config
+
+# Runs the bot as several processes, each owning some of the shards. The
+# content is parsed once, here, and saved as a catalog that every shard
+# process loads instead of parsing the csv files itself.
+# Process starts are spread out, since Discord only lets a bot identify
+# one shard every few seconds; a process that exits is started again,
+# waiting longer after each crash in a row. Every process reports its health
+# regularly, and the totals are logged and written to shards_health.json.
+# Run with `python shards.py --shards N --processes N`.
+
+_catalog_file = getattr(config, "catalog_file", "catalog.pickle")
+_health_file = "shards_health.json"
+# seconds between two processes starting, per shard they run
+_stagger = 5.0
+# how often the processes report their health, and the runner logs it
+_health_interval = 30.0
+# a process that stays up this long is considered stable again
+_stable_after = 300.0
+
+def _shard_process(index: int, shard_ids: List[int], shard_count: int, catalog: str, health) -> None:
+    os.environ["LEXIVE_SHARDS"] = f"{','.join(str(x) for x in shard_ids)}:{shard_count}"
+    os.environ["LEXIVE_CATALOG"] = catalog
+    import main # only now, so that it picks up the above
+
+    bot = main.bot
+
+    async def report_health():
+        while True:
+            latencies = [x for shard, x in bot.latencies if x == x] # NaN until connected
+            health.put((index, {
+                "pid": os.getpid(), "shards": shard_ids, "ready": bot.is_ready(), "guilds": len(bot.guilds),
+                "latency": sum(latencies) / len(latencies) if latencies else None, "time": time.time(),
+            }))
+            await asyncio.sleep(_health_interval)
+
+    async def run():
+        async with bot:
+            task = asyncio.ensure_future(report_health())
+            try:
+                await bot.start(config.token)
+            finally:
+                task.cancel()
+
+    asyncio.run(run())
+
+class _Shard:
+    def __init__(self, index: int, shard_ids: List[int]):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None # type: Optional[multiprocessing.Process]
+        self.started = 0.0
+        self.crashes = 0 # in a row
+        self.restarts = 0
+        self.start_at = 0.0
+        self.health = {} # type: dict
+
+def _split(shard_count: int, processes: int) -> List[List[int]]:
+    per = -(-shard_count // processes)
+    return [list(range(i, min(i + per, shard_count))) for i in range(0, shard_count, per)]
+
+def _summary(shards: List[_Shard]) -> dict:
+    alive = [x for x in shards if x.process is not None and x.process.is_alive()]
+    ready = [x for x in alive if x.health.get("ready")]
+    latencies = [x.health["latency"] for x in alive if x.health.get("latency") is not None]
+    return {
+        "processes": len(shards), "alive": len(alive), "ready": len(ready),
+        "shards": sum(len(x.shard_ids) for x in shards), "ready_shards": sum(len(x.shard_ids) for x in ready),
+        "guilds": sum(x.health.get("guilds", 0) for x in alive),
+        "latency": sum(latencies) / len(latencies) if latencies else None,
+        "restarts": sum(x.restarts for x in shards),
+        "per_process": {x.index: dict(x.health, alive=x in alive, restarts=x.restarts) for x in shards},
+    }
+
+def run(shard_count: int, processes: int) -> None:
+    load()
+    save_catalog(_catalog_file)
+
+    context = multiprocessing.get_context("spawn")
+    health = context.Queue()
+    shards = [_Shard(i, ids) for i, ids in enumerate(_split(shard_count, processes))]
+    next_start = 0.0
+    last_report = time.monotonic()
+
+    try:
+        while True:
+            now = time.monotonic()
+            for shard in shards:
+                if shard.process is not None and not shard.process.is_alive():
+                    code = shard.process.exitcode
+                    shard.process = None
+                    shard.health = {}
+                    if now - shard.started >= _stable_after:
+                        shard.crashes = 0
+                    shard.crashes += 1
+                    shard.restarts += 1
+                    delay = min(2 ** shard.crashes, 300)
+                    shard.start_at = now + delay
+                    log(f"Shard process {shard.index} exited with code {code}; restarting in {delay}s", level="error")
+
+            # only one process starts at a time, spaced out by how many shards the previous one identifies
+            due = [x for x in shards if x.process is None and now >= x.start_at]
+            if due and now >= next_start:
+                shard = min(due, key=lambda x: x.start_at)
+                shard.process = context.Process(target=_shard_process, name=f"lexive-shard-{shard.index}",
+                                                args=(shard.index, shard.shard_ids, shard_count, _catalog_file, health))
+                shard.process.start()
+                shard.started = now
+                next_start = now + _stagger * len(shard.shard_ids)
+                log(f"Started shard process {shard.index} (shards {shard.shard_ids}, pid {shard.process.pid})", level="local")
+
+            try:
+                while True:
+                    index, status = health.get(timeout=1)
+                    shards[index].health = status
+            except queue.Empty:
+                pass
+
+            if time.monotonic() - last_report >= _health_interval:
+                last_report = time.monotonic()
+                summary = _summary(shards)
+                log(f"Shards: {summary['alive']}/{summary['processes']} processes up, {summary['ready_shards']}/{summary['shards']} " +
+                    f"shards ready, {summary['guilds']} guilds, {summary['restarts']} restarts", level="local")
+                with open(_health_file, "wt") as f:
+                    json.dump(summary, f, indent=1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for shard in shards:
+            if shard.process is not None:
+                shard.process.terminate()
+        for shard in shards:
+            if shard.process is not None:
+                shard.process.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run Lexive as several shard processes")
+    parser.add_argument("--shards", type=int, default=getattr(config, "shard_count", 2), help="How many shards in total")
+    parser.add_argument("--processes", type=int, default=getattr(config, "shard_processes", 2), help="How many processes to spread them over")
+    args = parser.parse_args()
+    if not 1 <= args.processes <= args.shards:
+        parser.error("there must be between 1 process and one process per shard")
+    run(args.shards, args.processes)
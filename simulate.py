@@ -0,0 +1,196 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+import argparse
+import asyncio
+import os
+import re
+
+from discord.ext.commands.context import Context
+
+try:
+    import numpy as np
+except ImportError: # optional, only needed for the simulation
+    np = None
+
+from cmds import command, find_mage, ArgParser
+from loader import casefold, player_cards
+
+import config
+
+# Simulation of a mage's starting deck over the first few turns.
+# Each turn the whole hand is played: gems and relics give their aether, and
+# spells are prepped to the open breaches (best ones first) and cast, dealing
+# their damage. The played cards are discarded in a random order, and when the
+# deck runs out the discard pile is flipped over to form the new deck, as per
+# the rules. With --shuffle, the new deck is shuffled instead, to compare with
+# a regular deckbuilder.
+
+_simulate_args = ArgParser(prog="simulate", description="Simulate a mage's starting deck", add_help=False)
+_simulate_args.add_argument("--help", "-h", action="help", default=argparse.SUPPRESS, help="Prints this help message")
+_simulate_args.add_argument("mage", nargs="+", help="The mage to simulate")
+_simulate_args.add_argument("--turns", "-t", type=int, default=8, choices=range(1, 21), metavar="N", help="How many turns to simulate (1-20)")
+_simulate_args.add_argument("--runs", "-r", type=int, default=100000, metavar="N", help="How many games to simulate (1000-1000000, rounded up to a power of ten)")
+_simulate_args.add_argument("--shuffle", "-s", action="store_true", help="Shuffle the discard pile when forming a new deck")
+
+# the basic starters are not in player_cards
+_base_cards = {"Crystal": (1, 0, False), "Spark": (0, 1, True)}
+
+_aether_re = re.compile(r"Gain (\d+)\$")
+_damage_re = re.compile(r"Deal (\d+) damage")
+
+_workers = getattr(config, "simulation_workers", min(4, os.cpu_count() or 1))
+_pool = None # type: Optional[ProcessPoolExecutor]
+_cache = {} # type: Dict[tuple, str]
+_max_cached = 64
+# --runs is rounded up to one of these, so there are only so many results to cache
+_run_sizes = (1000, 10000, 100000, 1000000)
+# anything above this takes the pool long enough that only the owner may ask for it
+_max_public_runs = 100000
+
+def _card_effects(name: str, box: str) -> Optional[Tuple[int, int, bool]]:
+    """Return the aether gained, damage dealt and whether it's a spell."""
+    if name in _base_cards:
+        return _base_cards[name]
+    cards = player_cards.get(casefold(name))
+    if not cards:
+        return None
+    card = cards[0]
+    for c in cards: # prefer the printing from the mage's box
+        if c["box"] == box:
+            card = c
+            break
+
+    aether = damage = 0
+    text_code = card["code"][0]
+    if text_code: # only look at the first option, and the first gain/deal of it
+        for key, value in text_code[0]:
+            if key == "A" and not aether and value.isdigit():
+                aether = int(value)
+            elif key == "D" and not damage and value.isdigit():
+                damage = int(value)
+    else: # not parsed yet, fall back to the printed text
+        text = card["text"].split("OR")[0]
+        match = _aether_re.search(text)
+        if match:
+            aether = int(match.group(1))
+        match = _damage_re.search(text)
+        if match:
+            damage = int(match.group(1))
+    return aether, damage, "S" in card["type"]
+
+def _simulate_batch(aether, damage, spell, hand: int, breaches: int, turns: int, runs: int, shuffle: bool, seed: int):
+    """Play a batch of games at once; returns the sums and squared sums of aether and damage per turn."""
+    rng = np.random.default_rng(seed)
+    size = len(aether)
+    deck = np.tile(np.arange(size), (runs, 1)) # starting hand first, then the deck, in order
+    discard = np.empty((runs, 0), dtype=np.int64)
+    # spells sort before everything else, best ones first
+    spell_value = np.where(spell, damage * 100 + aether + 1, 0)
+    result = np.zeros((4, turns))
+
+    for turn in range(turns):
+        if deck.shape[1] < hand: # flip the discard pile under what's left
+            if shuffle:
+                discard = np.take_along_axis(discard, np.argsort(rng.random(discard.shape), axis=1), axis=1)
+            deck = np.concatenate([deck, discard], axis=1)
+            discard = discard[:, :0]
+        drawn, deck = deck[:, :hand], deck[:, hand:]
+
+        order = np.argsort(-spell_value[drawn], axis=1, kind="stable")
+        drawn = np.take_along_axis(drawn, order, axis=1)
+        cast = spell[drawn] & (np.cumsum(spell[drawn], axis=1) <= breaches)
+        played = ~spell[drawn] | cast
+        gained = (aether[drawn] * played).sum(axis=1)
+        dealt = (damage[drawn] * cast).sum(axis=1)
+        result[:, turn] = gained.sum(), (gained ** 2).sum(), dealt.sum(), (dealt ** 2).sum()
+
+        # the player discards in any order they like
+        drawn = np.take_along_axis(drawn, np.argsort(rng.random(drawn.shape), axis=1), axis=1)
+        discard = np.concatenate([discard, drawn], axis=1)
+
+    return result
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=_workers)
+    return _pool
+
+async def run_simulation(mat: dict, turns: int, runs: int, shuffle: bool) -> str:
+    hand, deck = mat["starting"]
+    cards = hand + deck
+    effects = []
+    unknown = []
+    for name in cards:
+        value = _card_effects(name, mat["box"])
+        if value is None:
+            unknown.append(name)
+            value = (0, 0, False)
+        effects.append(value)
+
+    breaches = sum(1 for pos, special in mat["breaches"] if pos == 0)
+    key = (mat["name"], mat["box"], mat["guild"], tuple(effects), breaches, turns, runs, shuffle)
+    cached = _cache.pop(key, None)
+    if cached is not None:
+        _cache[key] = cached
+        return cached
+
+    aether = np.array([x[0] for x in effects], dtype=np.int64)
+    damage = np.array([x[1] for x in effects], dtype=np.int64)
+    spell = np.array([x[2] for x in effects], dtype=bool)
+
+    loop = asyncio.get_running_loop()
+    batches = [runs // _workers + (i < runs % _workers) for i in range(_workers)]
+    seeds = np.random.SeedSequence().generate_state(len(batches))
+    futures = [loop.run_in_executor(_get_pool(), _simulate_batch, aether, damage, spell, len(hand), breaches,
+                                    turns, batch, shuffle, int(seed)) for batch, seed in zip(batches, seeds) if batch]
+    totals = sum(await asyncio.gather(*futures))
+
+    mean_a, mean_d = totals[0] / runs, totals[2] / runs
+    sd_a = np.sqrt(np.maximum(totals[1] / runs - mean_a ** 2, 0))
+    sd_d = np.sqrt(np.maximum(totals[3] / runs - mean_d ** 2, 0))
+
+    result = ["```", f"Starting deck of {mat['name']} over {runs} games" + (" (shuffling)" if shuffle else ""),
+              f"Open breaches: {breaches}", "", "Turn    Aether         Damage"]
+    for turn in range(turns):
+        result.append(f"{turn+1:>4}    {mean_a[turn]:5.2f} ± {sd_a[turn]:4.2f}  {mean_d[turn]:5.2f} ± {sd_d[turn]:4.2f}")
+    result.append("")
+    result.append(f"Total   {mean_a.sum():6.2f}         {mean_d.sum():6.2f}")
+    if unknown:
+        result.append("")
+        result.append(f"No aether or damage known for: {', '.join(unknown)}")
+    result.append("```")
+
+    if len(_cache) >= _max_cached: # drop the least recently used one
+        del _cache[next(iter(_cache))]
+    _cache[key] = "\n".join(result)
+    return _cache[key]
+
+@command()
+async def simulate(ctx: Context, *args):
+    if np is None:
+        await ctx.send("NumPy is not installed, cannot run the simulation.")
+        return
+    try:
+        namespace = _simulate_args.parse_args(args)
+    except (argparse.ArgumentError, RuntimeError) as e:
+        await ctx.send(str(e))
+        return
+    if not 1000 <= namespace.runs <= 1000000:
+        await ctx.send("The number of runs must be between 1000 and 1000000")
+        return
+    runs = next(x for x in _run_sizes if x >= namespace.runs)
+    if runs > _max_public_runs and not await ctx.bot.is_owner(ctx.author):
+        await ctx.send(f"Only the bot owner can simulate more than {_max_public_runs} games")
+        return
+
+    mat, error = find_mage(ctx.guild, " ".join(namespace.mage))
+    if mat is None:
+        await ctx.send(error)
+        return
+
+    if mat["starting"] is None:
+        await ctx.send(f"Could not figure out the starting cards of {mat['name']}")
+        return
+
+    await ctx.send(await run_simulation(mat, namespace.turns, runs, namespace.shuffle))
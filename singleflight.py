@@ -0,0 +1,31 @@
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+import asyncio
+
+import loader
+
+# Identical lookups that arrive while one is already running (a card that was
+# just spoiled, for example) wait for that one instead of computing the same
+# result again. Keys include the content generation, so that a lookup started
+# after !reload never gets the result from before it.
+
+T = TypeVar("T")
+
+_inflight = {} # type: Dict[tuple, asyncio.Future]
+
+stats = {"calls": 0, "coalesced": 0}
+
+async def coalesce(key: Hashable, func: Callable[..., Awaitable[T]], *args) -> T:
+    """Return await func(*args), sharing the computation with concurrent calls using the same key."""
+    key = (key, loader.generation)
+    stats["calls"] += 1
+    if key in _inflight:
+        stats["coalesced"] += 1
+        return await asyncio.shield(_inflight[key])
+
+    future = asyncio.ensure_future(func(*args))
+    _inflight[key] = future
+    future.add_done_callback(lambda f: _inflight.pop(key, None))
+    return await asyncio.shield(future)
+
+def report() -> str:
+    return f"Lookups: {stats['calls']} requested, {stats['coalesced']} coalesced, {len(_inflight)} running"
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from typing import List, Tuple
+import shlex
+
+import discord
+from discord import app_commands
+from discord.ext.commands.context import Context
+
+from cmds import cmds, command
+from loader import casefold, complete_names
+import loader
+
+# Slash commands for the most used commands. They run the same handlers as
+# the prefixed ones, through a stand-in for the context that answers the
+# interaction. Autocomplete uses the prefix index from the loader, and since
+# Discord asks again on nearly every keystroke, the last answer of each user
+# is kept: when they type one more letter, it is narrowed down from there.
+# The commands are registered with Discord by the owner, with !synccommands.
+
+_max_choices = 25
+# how many users to remember the last autocomplete of
+_max_recent = 1000
+
+# user -> (content generation, guild, kinds, query, results)
+_recent = OrderedDict() # type: OrderedDict[int, Tuple[int, int, tuple, str, List[Tuple[str, str]]]]
+
+stats = {"autocompletes": 0, "narrowed": 0}
+
+class _InteractionContext:
+    """Just enough of a Context for the command handlers, sending as interaction followups."""
+
+    def __init__(self, interaction: discord.Interaction):
+        self.interaction = interaction
+        self.guild = interaction.guild
+        self.author = interaction.user
+        self.bot = interaction.client
+        self.channel = interaction.channel
+
+    async def send(self, content=None, **kwargs):
+        return await self.interaction.followup.send(content, wait=True, **kwargs)
+
+def complete(user: int, guild: int, current: str, kinds: tuple) -> List[Tuple[str, str]]:
+    stats["autocompletes"] += 1
+    query = casefold(current)
+    last = _recent.get(user)
+    if last is not None and last[:3] == (loader.generation, guild, kinds) and query.startswith(last[3]) and len(last[4]) < _max_choices:
+        # the previous answer had everything that started with the shorter query
+        stats["narrowed"] += 1
+        results = [x for x in last[4] if x[0].startswith(query)]
+    else:
+        results = complete_names(guild, query, kinds, _max_choices)
+    _recent[user] = (loader.generation, guild, kinds, query, results)
+    _recent.move_to_end(user)
+    if len(_recent) > _max_recent:
+        _recent.popitem(last=False)
+    return results
+
+def _choices(interaction: discord.Interaction, current: str, kinds: tuple) -> List[app_commands.Choice[str]]:
+    guild = interaction.guild_id or 0
+    return [app_commands.Choice(name=name[:100], value=name[:100]) for key, name in complete(interaction.user.id, guild, current, kinds)]
+
+async def _run(interaction: discord.Interaction, name: str, *args: str) -> None:
+    await interaction.response.defer(thinking=True)
+    await cmds[name](_InteractionContext(interaction), *args)
+
+@app_commands.command(name="info", description="Look up a card, mat or unique mechanic")
+@app_commands.describe(name="What to look up")
+async def info_slash(interaction: discord.Interaction, name: str):
+    await _run(interaction, "info", *name.split())
+
+@info_slash.autocomplete("name")
+async def _info_complete(interaction: discord.Interaction, current: str):
+    return _choices(interaction, current, ("card", "mat", "mechanic"))
+
+@app_commands.command(name="card", description="Look up cards by their printed ID, such as AE55, 1a10-1a20 or W12,W13")
+@app_commands.describe(ids="One or more card IDs")
+async def card_slash(interaction: discord.Interaction, ids: str):
+    await _run(interaction, "card", *ids.split())
+
+@app_commands.command(name="box", description="List the cards in a box")
+@app_commands.describe(name="The box", type="Only list this type of card", page="Which page to show")
+async def box_slash(interaction: discord.Interaction, name: str, type: str = "", page: int = 1):
+    await _run(interaction, "box", *name.split(), *type.split(), str(page))
+
+@box_slash.autocomplete("name")
+async def _box_complete(interaction: discord.Interaction, current: str):
+    return _choices(interaction, current, ("box",))
+
+@app_commands.command(name="search", description="Search the text of all content")
+@app_commands.describe(text="The word or phrase to look for")
+async def search_slash(interaction: discord.Interaction, text: str):
+    await _run(interaction, "search", *text.split())
+
+@app_commands.command(name="random", description="Generate a random setup")
+@app_commands.describe(options="The same options as the prefixed command, e.g. -p 3 --expedition")
+async def random_slash(interaction: discord.Interaction, options: str = ""):
+    try:
+        args = shlex.split(options)
+    except ValueError as e:
+        await interaction.response.send_message(str(e), ephemeral=True)
+        return
+    await _run(interaction, "random", *args)
+
+def setup(bot) -> None:
+    for slash in (info_slash, card_slash, box_slash, search_slash, random_slash):
+        bot.tree.add_command(slash)
+
+@command()
+async def synccommands(ctx: Context, *args):
+    if await ctx.bot.is_owner(ctx.author):
+        synced = await ctx.bot.tree.sync()
+        await ctx.send(f"Registered {len(synced)} slash commands.")
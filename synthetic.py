@@ -0,0 +1,258 @@
+from typing import Dict, List
+import argparse
+import csv
+import os
+import random
+import shutil
+
+from code_parser import format, parse
+from loader import log
+
+# Writes made-up content in the layout of the real csv files: boxes with
+# their mages, market cards, nemeses, basic nemesis cards and treasures, and
+# guild overlays with boxes of their own. Card numbers, printed IDs, starting
+# hands, nemesis card lists and special breaches all refer to each other the
+# way the loader expects, and the text of the market cards is what the code
+# parser generates from their code. Some names are used again on purpose, as
+# reprints do, at the given rates. The same seed always gives the same files.
+# Run with `python synthetic.py DEST [--seed N] [--boxes N] [--guilds N]`.
+
+first_guild = 100000000000000000
+# copied from here, as they define the types rather than being content
+_meta_files = ("card_types.csv", "mage_ability_types.csv")
+
+_headers = {
+    "boxes.csv": "# Shorthand,Name,Wave",
+    "player_cards.csv": "# Name,Type,Cost,Code,Special,Text,Flavour text,Starter,Box,Deck,Start,End",
+    "nemesis_cards.csv": "# Name,Type,Tokens & HP,Shield,Tier,Category,Code,Special,To discard,Immediate,Effect,Flavour,Box,Deck,Start,End",
+    "player_mats.csv": "# Name,Title,Complexity rating,Ability name,Charges,Type,Code,Ability,Special text,Starting Breach Positions," +
+                       "Hand,Deck,Special I,Special II,Special III,Special IV,Flavour,Box",
+    "nemesis_mats.csv": "# Name,Health,Difficulty rating,Battle,Code,Expedtion rule modifications,Unleash,Setup,Increased difficulty (setup)," +
+                        "Increased difficulty (unleash),Increased difficulty (rules),Additional rules,Flavour,Side mat,Box,Cards",
+    "breaches.csv": "# Name,Position,Focus cost / open from up,Open from left,Open from down,Open from right,Additional effect,Used with",
+    "treasures.csv": "# Name,Type,Code,Effect,Flavour,Box,Deck,Number",
+}
+
+_adjectives = (
+    "Amber", "Ashen", "Bleak", "Blazing", "Bright", "Broken", "Burning", "Cinder", "Clouded", "Crimson", "Crystal", "Dark",
+    "Dread", "Ember", "Fallen", "Feral", "Frozen", "Gilded", "Hollow", "Iron", "Jagged", "Lost", "Molten", "Pale",
+    "Phantom", "Quiet", "Radiant", "Rusted", "Scorched", "Shattered", "Silent", "Silver", "Spectral", "Storm", "Sunken", "Thorned",
+    "Twisted", "Veiled", "Wild", "Withered",
+)
+_nouns = (
+    "Anchor", "Arc", "Blade", "Bloom", "Bolt", "Cairn", "Chalice", "Claw", "Crown", "Dagger", "Ember", "Eye",
+    "Fang", "Flame", "Gate", "Geode", "Heart", "Husk", "Lantern", "Lens", "Mirror", "Oath", "Opal", "Orb",
+    "Pearl", "Prism", "Quartz", "Relic", "Root", "Rune", "Seal", "Shard", "Sigil", "Spire", "Star", "Thorn",
+    "Tide", "Veil", "Vortex", "Wraith",
+)
+_places = ("Gravehold", "the Breach", "the Void", "the Depths", "the Mire", "the Spire", "the Hollows", "the Wastes")
+_roles = ("Weaponsmith", "Seer", "Elite", "Scholar", "Survivor", "Warden", "Pathfinder", "Vanguard")
+
+# market card code by type, with the amount to fill in; the special column goes with the part after ';'
+_market_codes = {
+    "G": ("A={0}", "A={0},N=1,&A=+1", "A={0},J=1,$=B"),
+    "R": ("J=1,$=B", "F,$=A", "C={0},$=B", "L={0},$=A", "G={0}"),
+    "S": ("D={0}", "D={0},C=1,$=C", "D={0},X", "D={0},L=1,$=A", "D={0},J=1,$=B", "D={0};D"),
+}
+_special_codes = {"D": "!Dual"}
+# how many of each a box has
+_mages = 4
+_market = {"G": 4, "R": 4, "S": 7}
+_nemeses = 3
+_nemesis_cards = 9
+_basics = 12
+_upgraded = 3
+_treasures = 3
+# position, focus cost and cost to open from the left, down and right
+_breaches = ((1, 0, 0, 0, 0), (2, 2, 3, 4, 5), (3, 3, 5, 7, 9), (4, 4, 7, 10, 13))
+
+def _letters(k: int, width: int) -> str:
+    value = ""
+    for i in range(width):
+        k, r = divmod(k, 26)
+        value = chr(ord("A") + r) + value
+    return value
+
+def _width(count: int) -> int:
+    width = 1
+    while 26 ** width < count:
+        width += 1
+    return width
+
+class _Names:
+    """Hands out new names, or one that was already used at the collision rate."""
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.count = 0
+        self.used = [] # type: List[str]
+
+    def __call__(self, collisions: float = 0.0) -> str:
+        if self.used and self.rng.random() < collisions:
+            return self.rng.choice(self.used)
+        i, self.count = self.count, self.count + 1
+        pairs = len(_adjectives) * len(_nouns)
+        pair = i * 617 % pairs # coprime with pairs, so that neighbours don't share a word
+        words = [_adjectives[pair % len(_adjectives)], _nouns[pair // len(_adjectives)]]
+        i //= pairs
+        while i: # of X, of X of Y, ...
+            i -= 1
+            i, r = divmod(i, len(_places))
+            words.append(f"of {_places[r].split()[-1].title()}")
+        name = " ".join(words)
+        self.used.append(name)
+        return name
+
+class _Box:
+    def __init__(self, name: str, prefix: str, wave: int, decks: bool):
+        self.name = name
+        self.prefix = prefix
+        self.wave = wave
+        self.decks = decks
+        self.numbers = {} # type: Dict[str, int]
+
+    def number(self, deck: str, count: int = 1) -> tuple:
+        """Take the next count numbers of that deck; returns (deck, start, end)."""
+        deck = deck if self.decks else ""
+        start = self.numbers.get(deck, 0) + 1
+        self.numbers[deck] = start + count - 1
+        return deck, start, start + count - 1
+
+def _flavour(rng: random.Random, speaker: str) -> str:
+    return f'"{rng.choice(_adjectives)} as the {rng.choice(_nouns).lower()} of {rng.choice(_places)}, and as {rng.choice(_adjectives).lower()}." - {speaker}'
+
+def _market_card(rng: random.Random, box: _Box, name: str, ctype: str, starter: str = "") -> list:
+    code = rng.choice(_market_codes[ctype]).format(rng.randint(1, 4))
+    cost = 0 if starter else rng.randint(2, 8)
+    text, special = parse(code, "P")
+    text = format(text, "PE", name, ctype)[0]
+    special = "#".join(_special_codes[key] for key, value in special)
+    deck, start, end = box.number("1a", 1 if starter else rng.randint(5, 7))
+    if starter:
+        end = 0
+    return [name, ctype, cost, code, special, text, _flavour(rng, starter or rng.choice(_roles)), starter, box.name, deck, start, end]
+
+def _nemesis_card(rng: random.Random, box: _Box, name: str, tier: int, category: str) -> list:
+    ctype = rng.choice(("P", "M", "A"))
+    tokens_hp = {"P": rng.randint(1, 4), "M": rng.randint(4, 15), "A": ""}[ctype]
+    damage = rng.randint(1, 6)
+    effect = {
+        "P": f"Power {tokens_hp}: Gravehold suffers {damage} damage.",
+        "M": f"Persistent: The player with the lowest life suffers {damage} damage.",
+        "A": f"Unleash twice. Any player suffers {damage} damage.",
+    }[ctype]
+    discard = f"Spend {damage + 4}$." if ctype == "P" else ""
+    deck, start, end = box.number("1b")
+    return [name, ctype, tokens_hp, "", tier, category, "", "", discard, "", effect, _flavour(rng, rng.choice(_roles)), box.name, deck, start, ""]
+
+def _card_id(deck: str, start: int) -> str:
+    return f"{deck}{start}"
+
+def _write(path: str, name: str, rows: List[list]) -> None:
+    with open(os.path.join(path, name), "wt", encoding="utf-8", newline="") as f:
+        f.write(_headers[name] + "\n")
+        csv.writer(f, dialect="excel", lineterminator="\n").writerows(rows)
+
+def _box_content(rng: random.Random, names: _Names, box: _Box, collisions: float, files: Dict[str, List[list]], mages: int,
+                 market: Dict[str, int], nemeses: int, basics: int, upgraded: int, treasures: int) -> None:
+    files["boxes.csv"].append([box.prefix, box.name, box.wave])
+
+    for i in range(mages):
+        mage = names(collisions).split()[-1] if rng.random() < 0.5 else names(collisions)
+        name = f"{mage} ({box.prefix})"
+        starter = _market_card(rng, box, f"{mage}'s {rng.choice(_nouns)}", rng.choice(("G", "S")), mage)
+        files["player_cards.csv"].append(starter)
+        specials = ["", "", "", ""]
+        if rng.random() < 0.25: # a breach of their own
+            position = rng.randrange(1, 4)
+            specials[position] = f"{names()} Breach"
+            files["breaches.csv"].append([specials[position], *_breaches[position], f"Once Opened: On Cast: Deal +{rng.randint(1, 2)} Damage.", name])
+        positions = [0] + [rng.randint(1, 4) for x in range(3)]
+        starting = _card_id(starter[9], starter[10])
+        hand = ["C", "C", "C", starting, "S"] if starter[1] == "S" else ["C", "C", starting, "S", "S"]
+        files["player_mats.csv"].append([
+            name, f"Breach Mage {rng.choice(_roles)}", rng.randint(1, 8), f"{names()}", rng.randint(4, 6), rng.choice(("M", "M", "M", "P", "A")),
+            "", f"Any ally gains {rng.randint(1, 3)} charges.", "", ",".join(str(x) for x in positions),
+            ",".join(hand), "C,C,C,C,S", *specials, _flavour(rng, name), box.name,
+        ])
+
+    for ctype, count in market.items():
+        for i in range(count):
+            files["player_cards.csv"].append(_market_card(rng, box, names(collisions), ctype))
+
+    for i in range(nemeses):
+        name = names(collisions)
+        cards = [_nemesis_card(rng, box, names(collisions), 1 + i * 3 // _nemesis_cards, name) for i in range(_nemesis_cards)]
+        files["nemesis_cards.csv"].extend(cards)
+        battle = rng.choice(("1", "2", "3", "4", "-"))
+        files["nemesis_mats.csv"].append([
+            name, rng.randint(40, 80), rng.randint(1, 10), battle, "NOEXP" if battle == "-" else "", "",
+            f"Gravehold suffers {rng.randint(1, 3)} damage.", f"Place {rng.randint(2, 4)} power tokens on this mat.", "", "", "", "",
+            _flavour(rng, rng.choice(_roles)), "", box.name, ",".join(_card_id(x[13], x[14]) for x in cards),
+        ])
+
+    for category, count in (("B", basics), ("U", upgraded)):
+        for i in range(count):
+            files["nemesis_cards.csv"].append(_nemesis_card(rng, box, names(collisions), 1 + i * 3 // count, category))
+
+    for i in range(treasures):
+        deck, start, end = box.number("1c")
+        files["treasures.csv"].append([names(collisions), rng.choice(("T2", "T3")), "", f"At the start of the game, gain {rng.randint(1, 3)} charges.",
+                                       _flavour(rng, rng.choice(_roles)), box.name, deck, start])
+
+def generate(dest: str, seed: int = 0, boxes: int = 26, guilds: int = 0, collisions: float = 0.05,
+             guild_cards: int = 20, guild_collisions: float = 0.5) -> None:
+    """Write a catalog of that many boxes, and that many guild overlays, into dest.
+
+    collisions is how often a name is one that was already used; guild_collisions
+    is the same for the overlays, whose names are then taken from everyone's content.
+    """
+    rng = random.Random(seed)
+    names = _Names(rng)
+    os.makedirs(dest, exist_ok=True)
+    for name in _meta_files:
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), dest)
+    for name in ("assets", "unique"): # neither has anything for made-up content
+        os.makedirs(os.path.join(dest, name), exist_ok=True)
+
+    files = {name: [] for name in _headers} # type: Dict[str, List[list]]
+    files["breaches.csv"].extend([f"Breach {x}", *values, "Once Opened: On Cast: Deal +1 Damage." if values[0] > 2 else "", ""]
+                                 for x, values in zip(("I", "II", "III", "IV"), _breaches))
+    # every prefix starts with X, and those of the guilds with G, all as long as the others
+    width = _width(boxes)
+    for i in range(boxes):
+        box = _Box(f"{names()} of {rng.choice(_places).split()[-1].title()}", "X" + _letters(i, width), 1 + i * 8 // max(boxes, 1), i % 3 == 0)
+        _box_content(rng, names, box, collisions, files, _mages, _market, _nemeses, _basics, _upgraded, _treasures)
+    for name, rows in files.items():
+        _write(dest, name, rows)
+
+    width = _width(guilds)
+    for i in range(guilds):
+        path = os.path.join(dest, "guilds", str(first_guild + i))
+        os.makedirs(path, exist_ok=True)
+        box = _Box(f"Guild {i} Promos", "G" + _letters(i, width), 1, False)
+        overlay = {name: [] for name in _headers}
+        market = {"G": guild_cards // 4, "R": guild_cards // 4, "S": guild_cards - 2 * (guild_cards // 4)}
+        _box_content(rng, names, box, guild_collisions, overlay, 1, market, 0, 0, 0, 1)
+        for name, rows in overlay.items():
+            if rows:
+                _write(path, name, rows)
+
+    log(f"Wrote {boxes} boxes and {guilds} guild overlays to {dest}", level="local")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write made-up content for testing the bot at scale")
+    parser.add_argument("dest", help="Directory to write the content to")
+    parser.add_argument("--seed", type=int, default=0, help="The same seed writes the same content")
+    parser.add_argument("--boxes", type=int, default=26, help="How many boxes of content to make")
+    parser.add_argument("--guilds", type=int, default=0, help="How many guild overlays to make")
+    parser.add_argument("--collisions", type=float, default=0.05, help="How often a name is one that was already used, from 0 to 1")
+    parser.add_argument("--guild-cards", type=int, default=20, help="How many market cards each guild overlay has")
+    parser.add_argument("--guild-collisions", type=float, default=0.5, help="How often a name in the overlays is one that was already used")
+    args = parser.parse_args()
+
+    if not 0 <= args.collisions <= 1 or not 0 <= args.guild_collisions <= 1:
+        parser.error("collision rates go from 0 to 1")
+    if args.boxes < 1 or args.guilds < 0 or args.guild_cards < 0:
+        parser.error("there must be at least one box, and no negative counts")
+    generate(args.dest, args.seed, args.boxes, args.guilds, args.collisions, args.guild_cards, args.guild_collisions)
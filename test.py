@@ -1,5 +1,14 @@
 from loader import load, log, player_cards
 from code_parser import format
+import asset_cache
+import asyncio
+import filecmp
+import loader
+import os
+import outbound
+import singleflight
+import synthetic
+import tempfile
 
 _error_str = """
 Mismatch #{count}:
@@ -26,6 +35,155 @@ def test_autogenerated_text():
                 count += 1
                 log(_error_str.format(count=count, name=card["name"], code=special, text=card["special"]), level="error")
 
+class _StubChannel:
+    """Stands in for the Discord HTTP client; uploads get a fake, non-expiring URL."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, *, file=None, embed=None):
+        self.sent.append(file or embed)
+        url = f"https://cdn.example/{file.filename}" if file else None
+        return type("Message", (), {"attachments": [type("Attachment", (), {"url": url})()] if url else []})()
+
+def test_asset_cache():
+    name = sorted(os.listdir("assets"))[0] # without needing load() to have run
+    channel = _StubChannel()
+    asset_cache.clear()
+    before = dict(asset_cache.stats) # they are kept across clear(), and other tests may send assets
+    async def send_twice():
+        await asset_cache.send_asset(channel, name)
+        await asset_cache.send_asset(channel, name)
+    asyncio.run(send_twice())
+    # the upload may be the optimised variant, under another extension
+    assert channel.sent[0].filename.startswith(name.rsplit(".", 1)[0]), channel.sent
+    assert channel.sent[1].image.url == f"https://cdn.example/{channel.sent[0].filename}", channel.sent
+    delta = {key: asset_cache.stats[key] - before[key] for key in before}
+    assert delta["uploads"] == 1 and delta["links"] == 1, delta
+
+class _FakeClock:
+    """Time that only passes when the queue sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float) -> None:
+        self.now += delay
+        await asyncio.sleep(0)
+
+class _FakeHTTP:
+    """Records what would have been sent to Discord, and when."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.requests = []
+
+    async def send(self, content=None, **kwargs):
+        self.requests.append((self.clock(), content, kwargs))
+        return len(self.requests)
+
+    async def fail(self, content=None, **kwargs):
+        raise RuntimeError("Missing Permissions")
+
+def test_send_queue():
+    clock = _FakeClock()
+    http = _FakeHTTP(clock)
+    queue = outbound.SendQueue(channel_rate=(3, 0.3), global_rate=(50, 1.0), clock=clock, sleep=clock.sleep)
+    async def send_all():
+        for i in range(5):
+            await queue.send(1, http.send, f"line {i}")
+        message = await queue.send(1, http.send, file="art")
+        for i in range(7):
+            await queue.send(1, http.send, str(i) * 1500)
+        failed = await queue.send(2, http.fail, "denied")
+        await queue.join()
+        # a worker that stops early fails what it had left, started or not
+        stopped = [await queue.send(3, http.send, str(i) * 1500) for i in range(4)]
+        await asyncio.sleep(0) # sends three, then waits for the bucket
+        queue.workers[3].cancel()
+        unsent = [await queue.send(4, http.send, "unsent")]
+        queue.workers[4].cancel()
+        await asyncio.gather(*stopped, *unsent, return_exceptions=True)
+        assert [x.exception() is None for x in stopped] == [True] * 3 + [False], stopped
+        assert isinstance(unsent[0].exception(), RuntimeError) and not queue.workers, unsent
+        return message, failed
+    message, failed = asyncio.run(send_all())
+    contents = [x[1] for x in http.requests]
+    # the small lines are merged, the file is sent on its own, in order
+    assert contents[0] == "\n".join(f"line {i}" for i in range(5)), contents[0]
+    assert http.requests[1][2] == {"file": "art"} and message == 2, http.requests[1]
+    assert contents[2:9] == [str(i) * 1500 for i in range(7)], contents
+    assert contents[9:] == [str(i) * 1500 for i in range(3)], contents
+    # never more than 3 requests in 0.3 seconds
+    times = [round(x[0], 6) for x in http.requests]
+    assert times[:9] == [0.0] * 3 + [0.3] * 3 + [0.6] * 3, times
+    # a text message that could not be sent hands its error to whoever waits for it
+    assert isinstance(failed.exception(), RuntimeError), failed
+    assert queue.stats["depth"] == 0 and queue.stats["merged"] == 4, queue.stats
+
+def test_coalesce():
+    calls = []
+    async def lookup(name):
+        calls.append(name)
+        await asyncio.sleep(0.01)
+        return name.upper()
+    async def lookup_all():
+        return await asyncio.gather(*(singleflight.coalesce(("test", name), lookup, name) for name in ("a", "a", "b", "a")))
+    assert asyncio.run(lookup_all()) == ["A", "A", "B", "A"]
+    assert calls == ["a", "b"], calls
+    assert singleflight.stats["coalesced"] >= 2, singleflight.stats
+
+def test_routing():
+    import harness, main # main registers the commands
+    def new_context():
+        return harness.FakeContext(harness.FakeBot(False), None, harness.FakeChannel(0), harness.FakeUser(0))
+    for request, expected in (("breach ii", "Breach II"), ("Breach II", "Breach II"), ("memory eater", "Memory Eater"), ("lash", "Lash (AE)")):
+        ctx = new_context()
+        asyncio.run(main.dispatch(ctx, request))
+        assert ctx.sent and expected in ctx.sent[0][0], (request, ctx.sent)
+    # the shortcuts complete_match always had, and a newer command when the lookup finds nothing
+    called = []
+    def record(name):
+        async def run(ctx, *args):
+            called.append((name, args))
+        return run
+    shortcuts = (("ran -p 2", "random"), ("sea blast", "search"), ("inf Jian", "info"), ("car AE5", "card"),
+                 ("rel", "reload"), ("que", "unique"), ("coll list", "collection"))
+    saved = dict(main.cmds)
+    main.cmds.update((name, record(name)) for request, name in shortcuts)
+    try:
+        for request, name in shortcuts:
+            asyncio.run(main.dispatch(new_context(), request))
+            assert called and called[-1] == (name, tuple(request.split()[1:])), (request, called)
+    finally:
+        main.cmds.update(saved)
+
+def test_synthetic():
+    root = os.getcwd()
+    with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+        synthetic.generate(first, seed=7, boxes=30, guilds=3)
+        synthetic.generate(second, seed=7, boxes=30, guilds=3)
+        files = [x for x in os.listdir(first) if x.endswith(".csv")]
+        assert not filecmp.cmpfiles(first, second, files, shallow=False)[1], "same seed, different content"
+        os.chdir(first)
+        try:
+            load()
+            assert len(loader.waves) == 33, len(loader.waves)
+            assert all(mat["starting"] and not any("ERROR" in x for x in mat["starting"][0])
+                       for mats in loader.player_mats.values() for mat in mats)
+            assert all(ref[0] != "?" for mats in loader.nemesis_mats.values() for mat in mats for ref in mat["card_refs"])
+        finally:
+            os.chdir(root)
+            load()
+
 if __name__ == "__main__":
     load()
     test_autogenerated_text()
+    test_asset_cache()
+    test_send_queue()
+    test_coalesce()
+    test_routing()
+    test_synthetic()
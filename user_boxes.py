@@ -0,0 +1,110 @@
+from typing import Dict, Iterable, List, Optional, Set
+import asyncio
+import atexit
+import sqlite3
+
+from loader import log
+
+import config
+
+# the boxes each user owns are kept in memory and written to the database
+# in batches, a little while after they change (or when the bot exits)
+_db_file = getattr(config, "boxes_db", "boxes.db")
+_flush_delay = getattr(config, "boxes_flush_delay", 30)
+
+_owned = {} # type: Dict[int, Set[str]]
+_dirty = set() # type: Set[int]
+_loaded = False
+_flush_handle = None # type: Optional[asyncio.TimerHandle]
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(_db_file)
+    conn.execute("CREATE TABLE IF NOT EXISTS boxes (user INTEGER NOT NULL, box TEXT NOT NULL, PRIMARY KEY (user, box))")
+    return conn
+
+def _load() -> None:
+    global _loaded
+    if _loaded:
+        return
+    conn = _connect()
+    try:
+        for user, box in conn.execute("SELECT user, box FROM boxes"):
+            _owned.setdefault(user, set()).add(box)
+    finally:
+        conn.close()
+    _loaded = True
+    log("User boxes loaded", level="local")
+
+def get_boxes(user: int) -> Optional[Set[str]]:
+    """Return the boxes that user registered, or None if they never did."""
+    _load()
+    return _owned.get(user)
+
+def set_boxes(user: int, boxes: Iterable[str]) -> None:
+    _load()
+    boxes = set(boxes)
+    if boxes:
+        _owned[user] = boxes
+    else:
+        _owned.pop(user, None)
+    _dirty.add(user)
+    _schedule_flush()
+
+def _write(rows: Dict[int, List[str]]) -> None:
+    conn = _connect()
+    try:
+        with conn:
+            for user, boxes in rows.items():
+                conn.execute("DELETE FROM boxes WHERE user = ?", (user,))
+                conn.executemany("INSERT INTO boxes (user, box) VALUES (?, ?)", [(user, box) for box in boxes])
+    finally:
+        conn.close()
+    log(f"Saved boxes for {len(rows)} user(s)", level="local")
+
+def _pending() -> Dict[int, List[str]]:
+    rows = {user: sorted(_owned.get(user, ())) for user in _dirty}
+    _dirty.clear()
+    return rows
+
+def flush() -> None:
+    """Write the changes now, in this thread (for the exit, and outside of the bot)."""
+    global _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    if not _dirty:
+        return
+    rows = _pending()
+    try:
+        _write(rows)
+    except Exception:
+        _dirty.update(rows)
+        raise
+
+def _flush_later() -> None:
+    # from the loop: write a copy in a thread, and try again later if that fails
+    global _flush_handle
+    _flush_handle = None
+    if not _dirty:
+        return
+    rows = _pending()
+
+    def done(future: asyncio.Future) -> None:
+        if future.exception() is not None:
+            log(f"Could not save the boxes of {len(rows)} user(s): {future.exception()}", level="error")
+            _dirty.update(rows)
+            _schedule_flush()
+
+    asyncio.get_running_loop().run_in_executor(None, _write, rows).add_done_callback(done)
+
+def _schedule_flush() -> None:
+    global _flush_handle
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError: # not running in the bot, just write it now
+        flush()
+        return
+    if _flush_handle is None:
+        _flush_handle = loop.call_later(_flush_delay, _flush_later)
+
+atexit.register(flush)